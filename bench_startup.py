@@ -0,0 +1,82 @@
+# bench_startup.py
+"""
+Käynnistysajan mittaus: tuo ui-moduulin erillisessä prosessissa (python -X importtime)
+ja tarkistaa, ettei raskaita kirjastoja (pandas, openpyxl, rapidfuzz) tuoda ennen
+ikkunan avautumista. Tulokset tulostetaan ja kirjoitetaan tiedostoon bench_output.txt.
+
+Käyttö:
+    python bench_startup.py [--runs 5]
+
+Palauttaa nollasta poikkeavan paluukoodin, jos jokin raskas kirjasto tuodaan käynnistyksessä.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+HEAVY_MODULES = ("pandas", "openpyxl", "rapidfuzz")
+OUTPUT_FILE = Path(__file__).parent / "bench_output.txt"
+
+
+def measure_import(module="ui"):
+    """
+    Tuo moduulin uudessa tulkissa. Palauttaa tuonnin kokonaiskeston (s), moduulien
+    kumulatiiviset kestot (s) ja käynnistyksessä tuodut raskaat kirjastot.
+    """
+    code = (
+        f"import sys, {module}; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing '{module}' failed:\n{completed.stderr}")
+
+    # Rivit muotoa "import time: self [us] | cumulative | imported package"
+    cumulative = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        cumulative[name.strip()] = int(cumulative_us) / 1e6
+    loaded_heavy = [m for m in completed.stdout.strip().split(",") if m]
+    return cumulative.get(module, 0.0), cumulative, loaded_heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mittaa ui-moduulin tuontiajan.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Näytettävien hitaimpien moduulien määrä")
+    args = parser.parse_args()
+
+    totals = []
+    loaded_heavy = []
+    for _ in range(args.runs):
+        total, cumulative, loaded_heavy = measure_import()
+        totals.append(total)
+
+    slowest = sorted(cumulative.items(), key=lambda item: item[1], reverse=True)[:args.top]
+    lines = [
+        f"import ui: median {statistics.median(totals) * 1000:.1f} ms, "
+        f"min {min(totals) * 1000:.1f} ms over {args.runs} runs",
+        "Slowest imports (cumulative, last run):",
+    ]
+    lines += [f"  {seconds * 1000:8.1f} ms  {name}" for name, seconds in slowest]
+    if loaded_heavy:
+        lines.append(f"FAIL: heavy modules imported at startup: {', '.join(loaded_heavy)}")
+    else:
+        lines.append(f"OK: none of {', '.join(HEAVY_MODULES)} imported at startup")
+
+    report = "\n".join(lines)
+    print(report)
+    OUTPUT_FILE.write_text(report + "\n", encoding="utf-8")
+    return 1 if loaded_heavy else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
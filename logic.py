@@ -1,15 +1,1107 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from pathlib import Path
-from openpyxl import load_workbook
+from openpyxl import Workbook, load_workbook
 from openpyxl.styles import PatternFill, Font, Border, Side, Alignment
 from openpyxl.utils import get_column_letter
+import hashlib
 import logging
-from rapidfuzz import fuzz
+import threading
+import tempfile
+from bisect import bisect_left
+import time
+from dataclasses import dataclass, replace
+from typing import Optional
+from rapidfuzz import fuzz, process
 
 # Konfiguroidaan lokitus, jotta näemme mitä koodissa tapahtuu
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+
+def as_key_list(key_column):
+    """
+    Palauttaa avainsarakkeen listana. Yksittäinen sarakenimi muutetaan yhden alkion listaksi,
+    jolloin yksinkertaiset ja yhdistelmäavaimet käsitellään samalla tavalla.
+    """
+    if isinstance(key_column, (list, tuple)):
+        return list(key_column)
+    return [key_column]
+
+
+def clean_code(code):
+    """
+    Siivoaa koodin etuliite- ja fuzzy-vertailua varten: välilyönnit pois ja pienet kirjaimet.
+    """
+    return str(code).replace(" ", "").strip().lower()
+
+
+def content_version(df):
+    """
+    Laskee datan sisällöstä (sarakkeet ja arvot) lyhyen versiotunnisteen.
+    """
+    digest = hashlib.sha1(repr(list(df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def clean_codes(values):
+    """
+    Vektoroitu clean_code koko sarakkeelle. Palauttaa object-taulukon, jossa puuttuvat arvot ovat None.
+    """
+    values = pd.Series(values).reset_index(drop=True)
+    cleaned = values.astype(str).str.replace(" ", "").str.strip().str.lower().astype(object)
+    cleaned[values.isna().to_numpy()] = None
+    return cleaned.to_numpy(dtype=object)
+
+
+def key_hashes(df, key_columns):
+    """
+    Laskee jokaiselle riville yhdistelmäavaimen (sarakkeiden arvojen tuple) 64-bittisen hajautusarvon.
+    Samat arvot tuottavat saman hajautusarvon sarakkeiden nimistä riippumatta.
+    """
+    return pd.util.hash_pandas_object(df[key_columns], index=False).to_numpy()
+
+
+def check_match_component(match_component, key_columns):
+    """
+    Tarkistaa, että vertailukomponentti on kelvollinen indeksi avainsarakkeisiin.
+    """
+    if isinstance(match_component, bool) or not isinstance(match_component, int) \
+            or not 0 <= match_component < len(key_columns):
+        logging.error(f"Match component {match_component!r} is out of range for key {list(key_columns)}.")
+        raise ValueError(f"Match component {match_component!r} is out of range for key {list(key_columns)}.")
+
+
+MATCH_TIERS = ("exact", "leading_zero", "prefix", "fuzzy")
+
+
+@dataclass(frozen=True)
+class MatchConfig:
+    """
+    Yhden yhdistämisajon muuttumattomat asetukset. Samaa indeksiä voidaan käyttää
+    rinnakkain useilla eri asetuksilla, koska ajon tila ei ole indeksissä eikä prosessorissa.
+
+    Avainsarakkeet voivat olla yksittäisiä sarakkeita tai listoja (yhdistelmäavain); ne
+    tallennetaan tupleina. Viiteavainsarakkeet poistetaan valituista sarakkeista.
+    """
+
+    ref_key_columns: tuple
+    offer_key_columns: tuple
+    selected_columns: tuple = ()
+    match_component: int = 0
+    fuzzy_threshold: int = 80
+    enabled_tiers: tuple = MATCH_TIERS
+    time_budget: Optional[float] = None
+    fuzzy_time_budget: Optional[float] = None
+
+    def __post_init__(self):
+        ref_keys = tuple(as_key_list(self.ref_key_columns))
+        offer_keys = tuple(as_key_list(self.offer_key_columns))
+        object.__setattr__(self, "ref_key_columns", ref_keys)
+        object.__setattr__(self, "offer_key_columns", offer_keys)
+        object.__setattr__(self, "selected_columns", tuple(col for col in self.selected_columns if col not in ref_keys))
+        object.__setattr__(self, "enabled_tiers", tuple(self.enabled_tiers))
+
+        # Yhdistelmäavaimissa molemmilla puolilla on oltava yhtä monta saraketta
+        if len(ref_keys) != len(offer_keys):
+            logging.error(f"Reference key {list(ref_keys)} and offer key {list(offer_keys)} have different lengths.")
+            raise ValueError(f"Reference key {list(ref_keys)} and offer key {list(offer_keys)} have different lengths.")
+        check_match_component(self.match_component, ref_keys)
+        for tier in self.enabled_tiers:
+            if tier not in MATCH_TIERS:
+                raise ValueError(f"Unknown match tier '{tier}'. Valid tiers: {', '.join(MATCH_TIERS)}.")
+
+        # Kynnys ja aikarajat ovat lukuja; aikarajat voivat puuttua (None = ei rajaa)
+        for name in ("fuzzy_threshold", "time_budget", "fuzzy_time_budget"):
+            value = getattr(self, name)
+            if value is None and name != "fuzzy_threshold":
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                logging.error(f"'{name}' must be a non-negative number, got {value!r}.")
+                raise ValueError(f"'{name}' must be a non-negative number, got {value!r}.")
+
+
+class CandidateGroup:
+    """
+    Yhden ryhmän etuliite- ja fuzzy-ehdokkaat: jokaisen siivotun koodin ensimmäinen (pienin)
+    viiterivi, koodien aakkosjärjestyksessä (sorted_codes ja rinnakkainen sorted_positions).
+
+    Muutokset tehdään paikallaan bisect-haulla, lisäyksellä ja poistolla indeksin lukon alla.
+    Haut eivät lukitse: changes-laskuri on muutoksen aikana pariton, ja haku toistetaan, jos
+    laskuri muuttui sen aikana. Taulukot voivat olla myös vain luettavia NumPy-näkymiä
+    (ks. shared_reference.py); ne muutetaan listoiksi vasta ensimmäisessä muutoksessa.
+    """
+
+    def __init__(self, sorted_codes, sorted_positions):
+        self.sorted_codes = sorted_codes
+        self.sorted_positions = sorted_positions
+        self.changes = 0
+
+    @classmethod
+    def from_rows(cls, codes, positions):
+        """
+        Luo ryhmän siivotuista koodeista ja niiden viiteriveistä nousevassa rivijärjestyksessä.
+        """
+        first = ~pd.Series(codes, dtype=object).duplicated().to_numpy()
+        codes, positions = codes[first], positions[first]
+        order = np.argsort(codes, kind="stable")
+        return cls(codes[order].tolist(), positions[order].tolist())
+
+    def __len__(self):
+        return len(self.sorted_codes)
+
+    def read(self, search):
+        """
+        Ajaa haun search(sorted_codes, sorted_positions) yhtenäiselle tilalle.
+        """
+        while True:
+            before = self.changes
+            if not before % 2:
+                try:
+                    result = search(self.sorted_codes, self.sorted_positions)
+                except IndexError:
+                    # Lista lyheni kesken haun; laskuri on muuttunut, joten haku toistetaan
+                    result = None
+                if self.changes == before:
+                    return result
+            time.sleep(0)
+
+    def set_representatives(self, representatives):
+        """
+        Asettaa koodien edustajarivit: koodi -> viiterivin paikka, tai None jos koodilla
+        ei ole enää voimassa olevia rivejä.
+        """
+        codes, positions = self.sorted_codes, self.sorted_positions
+        if not isinstance(codes, list):
+            codes, positions = [str(code) for code in codes], [int(pos) for pos in positions]
+
+        self.changes += 1
+        try:
+            self.sorted_codes, self.sorted_positions = codes, positions
+            for code, pos in representatives.items():
+                i = bisect_left(codes, code)
+                exists = i < len(codes) and codes[i] == code
+                if pos is None:
+                    if exists:
+                        del codes[i]
+                        del positions[i]
+                elif exists:
+                    positions[i] = pos
+                else:
+                    codes.insert(i, code)
+                    positions.insert(i, pos)
+        finally:
+            self.changes += 1
+
+    def find_prefix(self, cleaned_offer):
+        """
+        Etsii ensimmäisen viitekoodin, joka on tarjouskoodin alkuosa tai päinvastoin.
+        Palauttaa (siivottu koodi, viiterivin paikka) tai None.
+        """
+        def search(codes, positions):
+            best = None
+            # Viitekoodit, jotka ovat tarjouskoodin alkuosia: haetaan jokainen tarjouskoodin alkuosa
+            for length in range(len(cleaned_offer) + 1):
+                prefix = cleaned_offer[:length]
+                i = bisect_left(codes, prefix)
+                if i < len(codes) and codes[i] == prefix:
+                    if best is None or positions[i] < positions[best]:
+                        best = i
+
+            # Viitekoodit, jotka alkavat tarjouskoodilla, ovat aakkosjärjestyksessä peräkkäin
+            start = bisect_left(codes, cleaned_offer)
+            end = bisect_left(codes, cleaned_offer + "\U0010ffff", start)
+            if end > start:
+                i = start + int(np.argmin(positions[start:end]))
+                if best is None or positions[i] < positions[best]:
+                    best = i
+
+            # Useasta osumasta valitaan viitedatassa ensimmäisenä oleva, kuten järjestyksessä käytäessä
+            if best is None:
+                return None
+            return str(codes[best]), int(positions[best])
+
+        return self.read(search)
+
+    def find_fuzzy(self, cleaned_offer, threshold=80):
+        """
+        Etsii parhaan fuzzy-osuman (rapidfuzz). Tasapisteissä valitaan viitedatassa ensimmäisenä
+        oleva koodi. Palauttaa (siivottu koodi, viiterivin paikka) tai None, jos paras pistemäärä
+        jää alle kynnyksen.
+        """
+        def search(codes, positions):
+            if not len(codes):
+                return None
+            scores = process.cdist(
+                [cleaned_offer], codes, scorer=fuzz.token_sort_ratio, score_cutoff=threshold, dtype=np.float64
+            )[0]
+            best = scores.max()
+            if best <= 0 or best < threshold:
+                return None
+            i = min(np.flatnonzero(scores == best).tolist(), key=positions.__getitem__)
+            return str(codes[i]), int(positions[i])
+
+        return self.read(search)
+
+
+class ReferenceIndex:
+    """
+    Referenssidatan hakuindeksi. Tarkka vaihe haetaan yhdistelmäavaimen hajautusarvoista
+    yhdellä vektoroidulla haulla; etuliite- ja fuzzy-vaiheet kohdistuvat valittuun
+    avainkomponenttiin niiden viiterivien joukossa, joiden muut avainkomponentit täsmäävät.
+
+    Haut eivät muuta indeksiä (vain kerran rakennettavat ehdokaslistat luodaan lukon alla),
+    joten samaa indeksiä voi käyttää useasta säikeestä yhtä aikaa. Muutokset viedään indeksiin
+    apply_delta-metodilla, joka päivittää rakenteet paikallaan ja vaihtaa version tunnisteen.
+    """
+
+    def __init__(self, df_reference, key_columns, match_component=0):
+        self.set_key_columns(key_columns, match_component)
+
+        # Poistetaan duplikaatit avaimen perusteella; rivin paikka toimii viiterivin tunnisteena
+        df = df_reference.drop_duplicates(subset=self.key_columns, keep="first").reset_index(drop=True)
+        logging.info(f"Deduplicated reference data based on {self.key_columns}.")
+        self.set_data(df, key_hashes(df, self.key_columns))
+
+    @classmethod
+    def from_prepared(cls, df, key_columns, match_component, key_hash, group_hash, version=None, cleaned_codes=None,
+                      codes_present=None, candidate_table=None):
+        """
+        Luo indeksin valmiiksi deduplikoidusta datasta, sen hajautusarvoista ja siivotuista
+        vertailukoodeista ilman uudelleenlaskentaa (esim. muistiin kartoitetusta Arrow-tiedostosta,
+        ks. shared_reference.py).
+
+        codes_present kertoo, millä riveillä vertailukoodi on (tarvitaan, jos cleaned_codes ei
+        merkitse puuttuvia arvoja None-arvoina). candidate_table on valmiiksi laskettu ehdokastaulu
+        (ryhmät, koodit, paikat) järjestettynä ryhmän ja koodin mukaan; ehdokasryhmät luetaan sen
+        viipaleina eikä niitä rakenneta uudelleen.
+        """
+        index = cls.__new__(cls)
+        index.set_key_columns(key_columns, match_component)
+        index.set_data(df, key_hash, group_hash, version)
+        index.cleaned_codes = cleaned_codes
+        index.codes_present = codes_present
+        index.candidate_table = candidate_table
+        return index
+
+    def set_key_columns(self, key_columns, match_component):
+        """
+        Asettaa avainsarakkeet ja tarkistaa, että vertailukomponentti on jokin avaimen sarakkeista.
+        """
+        self.key_columns = as_key_list(key_columns)
+        check_match_component(match_component, self.key_columns)
+        self.match_component = match_component
+        self.match_column = self.key_columns[match_component]
+        self.other_columns = [col for i, col in enumerate(self.key_columns) if i != match_component]
+
+    def set_data(self, df, key_hash, group_hash=None, version=None):
+        """
+        Asettaa indeksin datan ja nollaa siitä johdetut rakenteet.
+        """
+        self.df = df
+        self.key_hash = key_hash
+        self.key_index = pd.Index(key_hash, copy=False)
+        # Poistetut rivit merkitään, jotta muiden rivien paikat (ja niihin viittaavat tulokset) säilyvät
+        self.removed = np.zeros(len(df), dtype=bool)
+        # Versiotunniste, jota välimuistit voivat käyttää avaimena; vaihtuu jokaisen muutoksen myötä.
+        # Alkuperäisen datan tunniste lasketaan vasta tarvittaessa.
+        self.version_stamp = version
+        # Muutosten laskuri, jolla laiskasti rakennettavat rakenteet tunnistavat kesken tulleen muutoksen
+        self.generation = 0
+        # Etuliite- ja fuzzy-ehdokkaat ryhmitellään muiden avainkomponenttien mukaan ja rakennetaan tarvittaessa
+        self.group_hash = group_hash
+        self.group_positions = None
+        # Vertailusarakkeen siivotut koodit (None = arvo puuttuu), lasketaan kerran
+        self.cleaned_codes = None
+        self.codes_present = None
+        # Valmiiksi laskettu ehdokastaulu (ks. from_prepared) ja rakennetut ehdokasryhmät
+        self.candidate_table = None
+        self.candidate_cache = {}
+        # Laiskasti rakennettavat rakenteet lasketaan lukon alla, jotta apply_delta ei pääse väliin
+        # laskennan ja julkaisun välillä; apply_delta käyttää niitä itse saman lukon alla
+        self.lock = threading.RLock()
+
+    @property
+    def version(self):
+        if self.version_stamp is None:
+            with self.lock:
+                if self.version_stamp is None:
+                    self.version_stamp = content_version(self.df)
+        return self.version_stamp
+
+    def warm_up(self):
+        """
+        Rakentaa etuliite- ja fuzzy-vaiheiden ehdokaslistat etukäteen kaikille ryhmille,
+        jotta ensimmäinen haku ei joudu odottamaan niiden rakentamista.
+        """
+        # Tarkan haun hajautustaulu rakennetaan ensimmäisellä get_indexer-kutsulla
+        self.key_index.get_indexer(self.key_hash[:1])
+        if self.candidate_table is not None:
+            # Ehdokastaulu on järjestetty ryhmän mukaan, joten ryhmät saadaan ilman ryhmittelyä
+            table_groups = self.candidate_table[0]
+            groups = table_groups[:1].tolist() + table_groups[1:][table_groups[1:] != table_groups[:-1]].tolist()
+        else:
+            groups = self.build_groups()
+        for group in groups:
+            self.candidates(group)
+        logging.info(f"Warmed up reference index with {len(self.df)} rows.")
+
+    def group_keys(self, df, other_columns):
+        """
+        Palauttaa jokaiselle riville ryhmän tunnisteen muiden avainkomponenttien perusteella.
+        Yksinkertaisella avaimella kaikki rivit kuuluvat samaan ryhmään.
+        """
+        if not other_columns:
+            return np.zeros(len(df), dtype=np.uint64)
+        return key_hashes(df, other_columns)
+
+    def build_group_hash(self):
+        """
+        Palauttaa viiterivien ryhmätunnisteet (lasketaan kerran).
+        """
+        if self.group_hash is None:
+            with self.lock:
+                if self.group_hash is None:
+                    self.group_hash = self.group_keys(self.df, self.other_columns)
+        return self.group_hash
+
+    def build_groups(self):
+        """
+        Ryhmittelee viiterivien paikat muiden avainkomponenttien mukaan (rakennetaan kerran).
+        """
+        if self.group_positions is None:
+            with self.lock:
+                if self.group_positions is None:
+                    groups = pd.Series(self.build_group_hash())
+                    self.group_positions = groups.groupby(groups, sort=False).indices
+        return self.group_positions
+
+    def build_cleaned_codes(self):
+        """
+        Palauttaa vertailusarakkeen siivotut koodit kaikille viiteriveille (lasketaan kerran vektoroidusti).
+        """
+        if self.cleaned_codes is None:
+            with self.lock:
+                if self.cleaned_codes is None:
+                    self.cleaned_codes = clean_codes(self.df[self.match_column])
+        return self.cleaned_codes
+
+    def code_mask(self, positions):
+        """
+        Palauttaa maskin annetuista riveistä, joilla vertailukoodi on olemassa.
+        """
+        if self.codes_present is not None:
+            return self.codes_present[positions]
+        return pd.notna(self.build_cleaned_codes()[positions])
+
+    def candidates(self, group):
+        """
+        Palauttaa ryhmän ehdokkaat CandidateGroup-oliona (rakennetaan kerran lukon alla).
+        Jos indeksillä on valmis ehdokastaulu, ryhmä on sen viipale (NumPy-näkymä) eikä kopio.
+        """
+        cached = self.candidate_cache.get(group)
+        if cached is None:
+            with self.lock:
+                cached = self.candidate_cache.get(group)
+                if cached is None:
+                    if self.candidate_table is not None:
+                        groups, codes, positions = self.candidate_table
+                        start = np.searchsorted(groups, group, side="left")
+                        end = np.searchsorted(groups, group, side="right")
+                        cached = CandidateGroup(codes[start:end], positions[start:end])
+                    else:
+                        cleaned = self.build_cleaned_codes()
+                        positions = self.build_groups().get(group, np.array([], dtype=np.intp))
+                        positions = positions[~self.removed[positions] & self.code_mask(positions)]
+                        cached = CandidateGroup.from_rows(cleaned[positions], positions)
+                    self.candidate_cache[group] = cached
+        return cached
+
+    def representatives(self, group, codes):
+        """
+        Laskee ryhmän annetuille koodeille edustajarivit (pienin voimassa oleva paikka, tai None)
+        yhdellä vektoroidulla läpikäynnillä.
+        """
+        positions = self.build_groups()[group]
+        positions = positions[~self.removed[positions] & self.code_mask(positions)]
+        group_codes = pd.Series(self.build_cleaned_codes()[positions], dtype=object)
+        hits = group_codes.isin(list(codes)).to_numpy()
+        first = pd.Series(positions[hits]).groupby(group_codes[hits].to_numpy()).min()
+        return {code: int(first[code]) if code in first.index else None for code in codes}
+
+    def lookup(self, df_keys):
+        """
+        Tarkka haku: palauttaa viiterivin paikan jokaiselle avaimelle, tai -1 jos osumaa ei ole.
+        """
+        positions = self.key_index.get_indexer(key_hashes(df_keys, list(df_keys.columns)))
+        removed = self.removed
+        hits = np.flatnonzero(positions >= 0)
+        positions[hits[removed[positions[hits]]]] = -1
+        return positions
+
+    def code_at(self, pos):
+        """
+        Palauttaa viiterivin siivotun vertailukoodin, tai None jos arvo puuttuu.
+        """
+        if self.cleaned_codes is not None:
+            if self.codes_present is not None and not self.codes_present[pos]:
+                return None
+            return str(self.cleaned_codes[pos])
+        value = self.df[self.match_column].iat[pos]
+        return None if pd.isna(value) else clean_code(value)
+
+    def apply_delta(self, upserts=None, removed_keys=None):
+        """
+        Päivittää indeksin muutoksilla. upserts sisältää lisätyt ja muuttuneet rivit (avainsarakkeet
+        ja hyötykuormasarakkeet), removed_keys poistettujen rivien avainsarakkeet.
+
+        Jo rakennetut etuliite- ja fuzzy-ehdokasryhmät päivitetään paikallaan vain niiden koodien
+        osalta, joihin muutos osuu. Poistot vain merkitään. Muuttuneiden rivien arvot kirjoitetaan
+        uuteen DataFrameen, joten aiemmat MatchResult-tulokset näkevät yhä oman versionsa; jos rivejä
+        lisätään, data ja tarkan haun hakurakenne kootaan uudelleen (kopio) lisättyjen rivien kanssa.
+
+        Uudet taulukot julkaistaan järjestyksessä data ensin ja hakurakenne viimeisenä, joten
+        samanaikaiset haut eivät näe paikkoja, joita datassa ei vielä ole.
+        Palauttaa uuden versiotunnisteen.
+        """
+        with self.lock:
+            base_version = self.version
+            removed = self.removed.copy()
+            # Rakennettujen ehdokasryhmien koodit, joiden edustajarivi voi muuttua: ryhmä -> {koodi}
+            touched = {}
+
+            def track(positions):
+                if self.group_hash is None:
+                    return
+                for pos in positions:
+                    group = self.group_hash[pos]
+                    code = self.code_at(pos)
+                    if code is None:
+                        continue
+                    if self.candidate_table is not None:
+                        # Ehdokastaulu kuvaa muutosta edeltävää tilaa: muuttuva ryhmä otetaan siitä
+                        # välimuistiin ennen muutosta, muut ryhmät voidaan yhä lukea taulusta
+                        self.candidates(group)
+                    if group in self.candidate_cache:
+                        touched.setdefault(group, set()).add(code)
+
+            # 1) Poistetut avaimet merkitään poistetuiksi
+            removed_positions = np.array([], dtype=np.intp)
+            if removed_keys is not None and len(removed_keys):
+                self.check_delta_columns(removed_keys)
+                positions = self.key_index.get_indexer(key_hashes(removed_keys, self.key_columns))
+                positions = positions[positions >= 0]
+                removed_positions = np.unique(positions[~removed[positions]])
+                removed[removed_positions] = True
+                track(removed_positions)
+
+            # 2) Muuttuneille (tai palautetuille) riveille kootaan uudet sarakkeet, uudet rivit lisätään loppuun.
+            # Vanhaa DataFramea ei muuteta, joten aiemmat tulokset voivat yhä lukea sitä.
+            df = self.df
+            changed_positions = np.array([], dtype=np.intp)
+            restored_positions = np.array([], dtype=np.intp)
+            added_positions = np.array([], dtype=np.intp)
+            if upserts is not None and len(upserts):
+                self.check_delta_columns(upserts)
+                upserts = upserts.drop_duplicates(subset=self.key_columns, keep="last").reset_index(drop=True)
+                hashes = key_hashes(upserts, self.key_columns)
+                positions = self.key_index.get_indexer(hashes)
+                existing = positions >= 0
+
+                changed_positions = positions[existing]
+                if len(changed_positions):
+                    # Muuttuneen rivin avain pysyy samana, joten sen siivottu koodi ja ryhmä eivät muutu;
+                    # ehdokaslistoihin lisätään vain aiemmin poistetut, nyt palautetut rivit
+                    restored_positions = changed_positions[removed[changed_positions]]
+                    df = df.copy(deep=False)
+                    for col in upserts.columns:
+                        if col in self.key_columns or col not in df.columns:
+                            continue
+                        column = df[col].copy()
+                        column.iloc[changed_positions] = upserts.loc[existing, col].to_numpy()
+                        df[col] = column
+                    removed[changed_positions] = False
+
+                new_rows = upserts.loc[~existing].reindex(columns=df.columns)
+                if len(new_rows):
+                    start = len(df)
+                    added_positions = np.arange(start, start + len(new_rows), dtype=np.intp)
+                    df = pd.concat([df, new_rows], ignore_index=True)
+                    removed = np.concatenate([removed, np.zeros(len(new_rows), dtype=bool)])
+                    if self.cleaned_codes is not None:
+                        new_codes = clean_codes(new_rows[self.match_column])
+                        if self.codes_present is not None:
+                            self.codes_present = np.concatenate([self.codes_present, pd.notna(new_codes)])
+                        self.cleaned_codes = np.concatenate([self.cleaned_codes, new_codes])
+                    if self.group_hash is not None:
+                        self.add_to_groups(self.group_keys(new_rows, self.other_columns), added_positions)
+
+            self.df = df
+            self.removed = removed
+            if len(added_positions):
+                self.key_hash = np.concatenate([self.key_hash, hashes[~existing]])
+                self.key_index = pd.Index(self.key_hash, copy=False)
+            track(restored_positions)
+            track(added_positions)
+
+            # 3) Päivitetään jo rakennettujen ehdokasryhmien muuttuneiden koodien edustajat
+            for group, codes in touched.items():
+                self.candidate_cache[group].set_representatives(self.representatives(group, codes))
+
+            self.generation += 1
+            self.version_stamp = self.next_version(base_version, upserts, removed_keys)
+            logging.info(
+                f"Applied delta to reference index: {len(added_positions)} added, {len(changed_positions)} changed, "
+                f"{len(removed_positions)} removed. Version {self.version}."
+            )
+            return self.version
+
+    def add_to_groups(self, new_groups, new_positions):
+        """
+        Lisää uusien rivien ryhmätunnisteet ja paikat ryhmittelyyn.
+        """
+        self.group_hash = np.concatenate([self.group_hash, new_groups])
+        if self.group_positions is not None:
+            group_positions = dict(self.group_positions)
+            new_members = pd.Series(new_groups).groupby(new_groups, sort=False).indices
+            for group, members in new_members.items():
+                existing = group_positions.get(group, np.array([], dtype=np.intp))
+                group_positions[group] = np.concatenate([existing, new_positions[members]])
+            self.group_positions = group_positions
+
+    def check_delta_columns(self, df):
+        for key_column in self.key_columns:
+            if key_column not in df.columns:
+                logging.error(f"Delta is missing reference key '{key_column}'.")
+                raise ValueError(f"Delta is missing reference key '{key_column}'.")
+
+    def next_version(self, base_version, upserts, removed_keys):
+        """
+        Johtaa uuden versiotunnisteen edellisestä versiosta ja muutoksen sisällöstä,
+        joten sama lähtöversio ja samat muutokset tuottavat aina saman tunnisteen.
+        """
+        digest = hashlib.sha1(base_version.encode("utf-8"))
+        for part in (upserts, removed_keys):
+            if part is not None and len(part):
+                digest.update(content_version(part).encode("utf-8"))
+            digest.update(b"|")
+        return digest.hexdigest()[:16]
+
+    def snapshot(self):
+        """
+        Palauttaa yhtenäisen parin (data, versiotunniste). Versio on None, jos alkuperäisen datan
+        tunnistetta ei ole vielä laskettu; se voidaan tällöin laskea palautetusta datasta.
+        """
+        with self.lock:
+            return self.df, self.version_stamp
+
+    def live_data(self):
+        """
+        Palauttaa indeksin voimassa olevat (poistamattomat) rivit.
+        """
+        return self.df[~self.removed]
+
+    def delta_from_snapshot(self, df_snapshot):
+        """
+        Laskee muutokset indeksin nykyisen datan ja uuden viitetiedoston välillä ja vie ne indeksiin.
+        """
+        upserts, removed_keys = diff_reference(self.live_data(), df_snapshot, self.key_columns)
+        return self.apply_delta(upserts, removed_keys)
+
+    def find_prefix(self, offer_code, group):
+        """
+        Etsii ensimmäisen viitekoodin, joka on tarjouskoodin alkuosa tai päinvastoin.
+        Palauttaa (siivottu koodi, viiterivin paikka) tai None.
+        """
+        return self.candidates(group).find_prefix(clean_code(offer_code))
+
+    def find_fuzzy(self, offer_code, group, threshold=80):
+        """
+        Etsii parhaan fuzzy-osuman (rapidfuzz). Palauttaa (siivottu koodi, viiterivin paikka)
+        tai None, jos paras pistemäärä jää alle kynnyksen.
+        """
+        return self.candidates(group).find_fuzzy(clean_code(offer_code), threshold)
+
+    def match(self, df_keys, config=None):
+        """
+        Hakee viiterivit tarjousavaimille vaiheittain: tarkka osuma, '0'-etuliite,
+        etuliitevertailu ja fuzzy matching. Sarakkeiden järjestys vastaa indeksin avainsarakkeita.
+        Käytössä olevat vaiheet, fuzzy-kynnys ja aikarajat tulevat MatchConfig-asetuksista.
+
+        time_budget rajaa koko haun keston ja fuzzy_time_budget pelkän fuzzy-vaiheen keston
+        (sekunteina, None = ei rajaa). Kun aika loppuu, jo löydetyt osumat säilytetään ja
+        jäljellä olevat rivit jätetään yhdistämättä.
+        Palauttaa tuloksen MatchResult-oliona, jonka taulukon rivit vastaavat df_keys-rivejä.
+        """
+        if config is None:
+            config = MatchConfig(self.key_columns, list(df_keys.columns), match_component=self.match_component)
+        if config.match_component != self.match_component:
+            raise ValueError(
+                f"Match component {config.match_component} differs from the index match component {self.match_component}."
+            )
+        enabled = config.enabled_tiers
+        time_budget = config.time_budget
+        fuzzy_time_budget = config.fuzzy_time_budget
+        threshold = config.fuzzy_threshold
+
+        started = time.monotonic()
+        run_deadline = started + time_budget if time_budget is not None else None
+        df_keys = df_keys.reset_index(drop=True)
+        match_col = df_keys.columns[self.match_component]
+        other_cols = [col for i, col in enumerate(df_keys.columns) if i != self.match_component]
+        used_codes = df_keys[match_col].to_numpy(dtype=object, copy=True)
+        tiers = np.full(len(df_keys), None, dtype=object)
+        skipped = np.zeros(len(df_keys), dtype=bool)
+        # Vaihekohtaiset kestot (s), niistä ehdokasryhmien rakentamiseen kulunut osuus ja käsiteltyjen rivien määrät
+        tier_seconds = {}
+        build_seconds = {}
+        tier_attempts = {}
+
+        # 1) Tarkka osuma koko avaimella
+        if "exact" in enabled:
+            tier_started = time.monotonic()
+            positions = self.lookup(df_keys)
+            tiers[positions >= 0] = "exact"
+            tier_seconds["exact"] = time.monotonic() - tier_started
+            tier_attempts["exact"] = len(df_keys)
+            logging.info("Performed initial merge.")
+        else:
+            positions = np.full(len(df_keys), -1, dtype=np.intp)
+
+        # 2) Yritetään yhdistää lisäämällä tarjousavaimeen eteen '0'
+        unmatched = np.flatnonzero(positions < 0)
+        if len(unmatched) and "leading_zero" in enabled:
+            logging.info(f"Found {len(unmatched)} unmatched records. Attempting match with a leading '0'.")
+            tier_started = time.monotonic()
+            df_zero = df_keys.iloc[unmatched].copy()
+            df_zero[match_col] = '0' + df_zero[match_col].astype(str)
+            zero_positions = self.lookup(df_zero)
+            found = zero_positions >= 0
+            positions[unmatched[found]] = zero_positions[found]
+            used_codes[unmatched[found]] = df_zero[match_col].to_numpy()[found]
+            tiers[unmatched[found]] = "leading_zero"
+            tier_seconds["leading_zero"] = time.monotonic() - tier_started
+            tier_attempts["leading_zero"] = len(unmatched)
+            logging.info("Performed secondary merge with leading '0'.")
+
+        # 3) ja 4) Etuliitevertailu ja fuzzy matching valitulle avainkomponentille
+        search_tiers = (
+            ("prefix", "alternative prefix matching", self.find_prefix, None),
+            ("fuzzy", "fuzzy matching", lambda code, group: self.find_fuzzy(code, group, threshold), fuzzy_time_budget),
+        )
+        for tier, label, finder, tier_budget in search_tiers:
+            if tier not in enabled:
+                continue
+            unmatched = np.flatnonzero(positions < 0)
+            if not len(unmatched):
+                break
+            logging.info(f"{len(unmatched)} records still unmatched. Trying {label}.")
+            tier_started = time.monotonic()
+            tier_attempts[tier] = len(unmatched)
+            groups = self.group_keys(df_keys.iloc[unmatched], other_cols)
+            codes = df_keys[match_col].to_numpy()[unmatched]
+            # Tarvittavat ehdokasryhmät rakennetaan ennen vaiheen aikarajan alkua, jotta raja kuluu
+            # vain hakuihin; koko haun aikarajaa valvotaan myös rakentamisen aikana
+            for group in pd.unique(groups):
+                if run_deadline is not None and time.monotonic() >= run_deadline:
+                    break
+                self.candidates(group)
+            build_seconds[tier] = time.monotonic() - tier_started
+            deadline = run_deadline
+            if tier_budget is not None:
+                tier_deadline = time.monotonic() + tier_budget
+                deadline = tier_deadline if deadline is None else min(deadline, tier_deadline)
+            for n, (row, offer_code, group) in enumerate(zip(unmatched, codes, groups)):
+                if deadline is not None and time.monotonic() >= deadline:
+                    skipped[unmatched[n:]] = True
+                    tier_attempts[tier] = n
+                    logging.warning(f"Time budget spent during {label}; {len(unmatched) - n} rows left unmatched.")
+                    break
+                result = finder(offer_code, group)
+                if result is not None:
+                    used_codes[row], positions[row] = result
+                    tiers[row] = tier
+            tier_seconds[tier] = time.monotonic() - tier_started
+
+        result = MatchResult(
+            self, positions, tiers, used_codes, int(skipped.sum()), tier_seconds, tier_attempts, build_seconds
+        )
+        logging.info(f"Matching took {time.monotonic() - started:.2f} s; {result.skipped_for_time} rows skipped for time.")
+        return result
+
+
+DELTA_ACTION_COLUMN = "action"
+
+
+def diff_reference(df_old, df_new, key_columns):
+    """
+    Vertaa kahta viitedatan versiota avaimen perusteella. Palauttaa lisätyt ja muuttuneet rivit
+    (uuden version sarakkein) sekä poistettujen rivien avainsarakkeet.
+    """
+    key_columns = as_key_list(key_columns)
+    df_old = df_old.drop_duplicates(subset=key_columns, keep="first").reset_index(drop=True)
+    df_new = df_new.drop_duplicates(subset=key_columns, keep="first").reset_index(drop=True)
+
+    # Sarakkeiden lisäystä tai poistoa ei voi esittää rivimuutoksina, joten katalogi on ladattava uudelleen
+    added_columns = [col for col in df_new.columns if col not in df_old.columns]
+    removed_columns = [col for col in df_old.columns if col not in df_new.columns]
+    if added_columns or removed_columns:
+        logging.error(f"Reference columns changed (added: {added_columns}, removed: {removed_columns}).")
+        raise ValueError(
+            f"Reference columns changed (added: {added_columns}, removed: {removed_columns}); "
+            f"reload the reference instead of applying a delta."
+        )
+
+    old_index = pd.Index(key_hashes(df_old, key_columns))
+    new_index = pd.Index(key_hashes(df_new, key_columns))
+    positions = old_index.get_indexer(new_index)
+
+    # Muuttuneet rivit tunnistetaan rivikohtaisista hajautusarvoista (sarakkeet samassa järjestyksessä)
+    columns = list(df_new.columns)
+    new_rows = pd.util.hash_pandas_object(df_new[columns], index=False).to_numpy()
+    old_rows = pd.util.hash_pandas_object(df_old[columns], index=False).to_numpy()
+    existing = positions >= 0
+    changed = np.zeros(len(df_new), dtype=bool)
+    changed[existing] = new_rows[existing] != old_rows[positions[existing]]
+
+    upserts = df_new[~existing | changed]
+    removed_keys = df_old.loc[new_index.get_indexer(old_index) < 0, key_columns]
+    logging.info(
+        f"Computed reference delta: {int((~existing).sum())} added, {int(changed.sum())} changed, "
+        f"{len(removed_keys)} removed."
+    )
+    return upserts, removed_keys
+
+
+def read_delta_file(delta_file, key_columns):
+    """
+    Lukee muutostiedoston (Excel tai CSV). Sarake 'action' kertoo rivin muutoksen:
+    'add', 'change' tai 'remove'. Palauttaa lisättävät/muutettavat rivit ja poistettavat avaimet.
+    """
+    key_columns = as_key_list(key_columns)
+    try:
+        if str(delta_file).lower().endswith(".csv"):
+            df_delta = pd.read_csv(delta_file, dtype=str)
+        else:
+            df_delta = pd.read_excel(delta_file, dtype=str)
+    except Exception as e:
+        logging.error(f"Could not read the delta file: {e}")
+        raise ValueError(f"Could not read the delta file: {e}")
+
+    if DELTA_ACTION_COLUMN not in df_delta.columns:
+        raise ValueError(f"Delta file must have an '{DELTA_ACTION_COLUMN}' column.")
+    for key_column in key_columns:
+        if key_column not in df_delta.columns:
+            raise ValueError(f"Delta is missing reference key '{key_column}'.")
+
+    actions = df_delta[DELTA_ACTION_COLUMN].str.strip().str.lower()
+    unknown = set(actions.dropna()) - {"add", "change", "remove"}
+    if unknown or actions.isna().any():
+        raise ValueError(f"Unknown delta actions: {sorted(unknown) or ['<empty>']}.")
+    df_delta = df_delta.drop(columns=[DELTA_ACTION_COLUMN])
+    upserts = df_delta[actions.isin(["add", "change"]).to_numpy()]
+    removed_keys = df_delta.loc[(actions == "remove").to_numpy(), key_columns]
+    return upserts, removed_keys
+
+
+def read_reference(reference_file, config):
+    """
+    Lukee viitetiedoston ja tarkistaa, että avainsarakkeet ja valitut sarakkeet löytyvät.
+    """
+    try:
+        df_reference = pd.read_excel(reference_file, dtype=str)
+        logging.info(f"Reference file '{reference_file}' loaded successfully.")
+    except Exception as e:
+        logging.error(f"Could not read the reference file: {e}")
+        raise ValueError(f"Could not read the reference file: {e}")
+
+    # Tarkistetaan, että viiteavaimesarakkeet löytyvät viitetiedostosta
+    for key_column in config.ref_key_columns:
+        if key_column not in df_reference.columns:
+            logging.error(f"Chosen reference key '{key_column}' not found in reference file.")
+            raise ValueError(f"Chosen reference key '{key_column}' not found in reference file.")
+
+    # Tarkistetaan, että käyttäjän valitsemat sarakkeet löytyvät viitetiedostosta
+    for col in config.selected_columns:
+        if col not in df_reference.columns:
+            logging.error(f"Selected column '{col}' not in reference file.")
+            raise ValueError(f"Selected column '{col}' not in reference file.")
+    return df_reference
+
+
+def read_offer_keys(offer_file, config):
+    """
+    Lukee tarjoustiedostosta vain avainsarakkeet ja tarkistaa, että ne löytyvät.
+    """
+    try:
+        df_offer = pd.read_excel(offer_file, dtype=str, usecols=lambda col: col in config.offer_key_columns)
+        logging.info(f"Offer file '{offer_file}' loaded successfully.")
+    except Exception as e:
+        logging.error(f"Could not read the offer file: {e}")
+        raise ValueError(f"Could not read the offer file: {e}")
+
+    # Tarkistetaan, että tarjousavaimesarakkeet löytyvät tarjoustiedostosta
+    for key_column in config.offer_key_columns:
+        if key_column not in df_offer.columns:
+            logging.error(f"Chosen offer key '{key_column}' not found in offer file.")
+            raise ValueError(f"Chosen offer key '{key_column}' not found in offer file.")
+    return df_offer
+
+
+def match_offer(index, df_offer, config):
+    """
+    Tilaton haku: siivoaa tarjouksen avainsarakkeet ja hakee niille viiterivit indeksistä.
+    Tarjouksen DataFramea tai indeksiä ei muuteta. Palauttaa MatchResult-tuloksen.
+    """
+    if list(config.ref_key_columns) != index.key_columns:
+        raise ValueError(f"Reference key {list(config.ref_key_columns)} does not match index key {index.key_columns}.")
+    for col in config.selected_columns:
+        if col not in index.df.columns:
+            logging.error(f"Selected column '{col}' not in reference file.")
+            raise ValueError(f"Selected column '{col}' not in reference file.")
+
+    # Poistetaan välilyönnit ja trimmaillaan tarjousavaimen vertailukomponentin arvot. Muut
+    # komponentit (esim. valmistajan nimi tai "10 kpl") verrataan sellaisenaan, kuten viitedatassa.
+    match_column = config.offer_key_columns[config.match_component]
+    df_keys = pd.DataFrame({
+        col: df_offer[col].str.replace(" ", "").str.strip() if col == match_column else df_offer[col]
+        for col in config.offer_key_columns
+    })
+    logging.info(f"Removed spaces and stripped offer key column '{match_column}'.")
+
+    # Haetaan jokaiselle tarjousriville viiterivi (tarkka, '0'-etuliite, etuliite ja fuzzy)
+    return index.match(df_keys, config)
+
+
+def process_offer(index, offer_file, config):
+    """
+    Tilaton kokonaisajo jaettua, vain luettavaa indeksiä vasten: lukee tarjouksen avaimet,
+    hakee osumat ja tallentaa tuloksen uuteen Excel-tiedostoon. Turvallinen kutsua
+    rinnakkain useasta säikeestä. Palauttaa tiedoston polun, puuttuvien määrän ja tuloksen.
+    """
+    df_offer = read_offer_keys(offer_file, config)
+    result = match_offer(index, df_offer, config)
+    output_path, missing_count = ExcelProcessor().save_to_excel(offer_file, result, config)
+    if result.skipped_for_time:
+        logging.warning(f"{result.skipped_for_time} rows were left unmatched because the time budget ran out.")
+    return output_path, missing_count, result
+
+
+# Jos tarkkojen osumien osuus jää tämän alle, valitut avainsarakkeet ovat todennäköisesti väärät
+DRY_RUN_MIN_EXACT_RATE = 0.05
+
+
+def dry_run(reference_file, offer_file, config, sample_size=200, seed=None):
+    """
+    Koeajo ennen varsinaista ajoa: ajaa satunnaisotoksen tarjousriveistä kaikkien vaiheiden läpi,
+    raportoi osumaosuudet vaiheittain ja arvioi jokaisen vaiheen ja koko ajon keston koko
+    tarjoustiedostolle. Tulostiedostoa ei kirjoiteta. Aikarajat jätetään huomiotta, jotta
+    arvio kuvaa rajoittamatonta ajoa.
+
+    Viitetiedoston luku, indeksin rakentaminen ja tarjouksen luku mitataan sellaisenaan.
+    Tarkka ja '0'-etuliitevaihe ovat vektoroituja, joten niiden kesto mitataan ajamalla ne koko
+    tarjoukselle; etuliite- ja fuzzy-vaiheiden hakujen kestot skaalataan otoksesta rivimäärän
+    suhteessa ja ehdokasryhmien kertaluonteinen rakentaminen lisätään sellaisenaan, kuten
+    varsinaisessa ajossa.
+    Tallennuksen kesto arvioidaan kirjoittamalla otoksen tulos väliaikaiseen tiedostoon
+    (ks. estimate_save_seconds). Palauttaa raportin sanakirjana.
+    """
+    config = replace(config, time_budget=None, fuzzy_time_budget=None)
+    seconds = {}
+
+    stage_started = time.monotonic()
+    df_reference = read_reference(reference_file, config)
+    seconds["read_reference"] = time.monotonic() - stage_started
+
+    stage_started = time.monotonic()
+    index = ReferenceIndex(df_reference, config.ref_key_columns, config.match_component)
+    seconds["build_index"] = time.monotonic() - stage_started
+
+    stage_started = time.monotonic()
+    df_offer = read_offer_keys(offer_file, config)
+    seconds["read_offer"] = time.monotonic() - stage_started
+
+    total_rows = len(df_offer)
+    sample = df_offer.sample(n=min(sample_size, total_rows), random_state=seed)
+    result = match_offer(index, sample, config)
+    scale = total_rows / len(sample) if len(sample) else 0
+
+    # Vektoroidut vaiheet ajetaan koko tarjoukselle, koska niiden kesto ei kasva rivimäärän suhteessa
+    lookup_tiers = tuple(tier for tier in ("exact", "leading_zero") if tier in config.enabled_tiers)
+    full_seconds = {}
+    if lookup_tiers and total_rows:
+        full_seconds = match_offer(index, df_offer, replace(config, enabled_tiers=lookup_tiers)).tier_seconds
+
+    tier_counts = result.table["tier"].value_counts()
+    tiers = {}
+    for tier in MATCH_TIERS:
+        if tier not in config.enabled_tiers:
+            continue
+        matches = int(tier_counts.get(tier, 0))
+        sample_seconds = result.tier_seconds.get(tier, 0.0)
+        if tier in lookup_tiers:
+            estimated = full_seconds.get(tier, 0.0)
+        else:
+            # Ehdokasryhmät rakennetaan kerran ajoa kohden, joten vain haut skaalataan
+            build = result.build_seconds.get(tier, 0.0)
+            estimated = build + (sample_seconds - build) * scale
+        tiers[tier] = {
+            "matches": matches,
+            "rate": matches / len(sample) if len(sample) else 0.0,
+            "rows_reaching": result.tier_attempts.get(tier, 0),
+            "sample_seconds": sample_seconds,
+            "estimated_seconds": estimated,
+        }
+        seconds[tier] = estimated
+    seconds["save"] = estimate_save_seconds(offer_file, result, config, total_rows)
+
+    unmatched = int((~result.matched).sum())
+    exact_matches = sum(tiers.get(tier, {}).get("matches", 0) for tier in ("exact", "leading_zero"))
+    warnings = []
+    if not total_rows:
+        warnings.append("The offer file has no rows.")
+    else:
+        empty_rate = float(sample[list(config.offer_key_columns)].isna().any(axis=1).mean())
+        if empty_rate > 0.5:
+            warnings.append(f"{empty_rate:.0%} of sampled rows have an empty offer key {list(config.offer_key_columns)}.")
+        exact_rate = exact_matches / len(sample)
+        if exact_rate < DRY_RUN_MIN_EXACT_RATE:
+            warnings.append(
+                f"Only {exact_rate:.1%} of sampled rows match exactly on {list(config.ref_key_columns)} / "
+                f"{list(config.offer_key_columns)}; almost all rows would go through the slow prefix and "
+                f"fuzzy tiers. Check the chosen key columns."
+            )
+    for warning in warnings:
+        logging.warning(warning)
+
+    report = {
+        "total_rows": total_rows,
+        "sample_rows": len(sample),
+        "tiers": tiers,
+        "unmatched_rate": unmatched / len(sample) if len(sample) else 0.0,
+        "estimated_seconds": seconds,
+        "estimated_total_seconds": sum(seconds.values()),
+        "warnings": warnings,
+    }
+    logging.info(
+        f"Dry run on {len(sample)}/{total_rows} rows: estimated total {report['estimated_total_seconds']:.1f} s, "
+        f"unmatched rate {report['unmatched_rate']:.1%}."
+    )
+    return report
+
+
+# Montako tarjoustiedoston riviä tallennusarviossa luetaan työkirjan latauksen keston arvioimiseksi;
+# pienemmällä rivimäärällä kiinteät kustannukset vääristävät rivikohtaista kestoa
+SAVE_ESTIMATE_LOAD_ROWS = 2000
+
+
+def estimate_save_seconds(offer_file, result, config, total_rows):
+    """
+    Arvioi tuloksen tallennuksen keston koko tarjoukselle kopioimatta koko työkirjaa muistiin.
+    Tarjoustiedosto avataan vain luku -tilassa, ja sen enintään SAVE_ESTIMATE_LOAD_ROWS
+    ensimmäistä riviä kopioidaan uuteen työkirjaan; kopioinnin kesto skaalataan koko työkirjan
+    latauksen arvioksi rivimäärän suhteessa. Kopio rajataan sen jälkeen otsikkoriviin ja otoksen
+    kokoiseen rivimäärään, ja siihen kirjoitetaan ja muotoillaan otoksen tulos samoin kuin
+    ExcelProcessor.save_to_excel tekee (skaalataan rivimäärän suhteessa), ja se tallennetaan
+    väliaikaiseen tiedostoon (skaalataan kirjoitettavien solujen määrän suhteessa).
+    """
+    processor = ExcelProcessor()
+    sample_rows = len(result)
+
+    started = time.monotonic()
+    source = load_workbook(offer_file, read_only=True)
+    try:
+        source_ws = source.active
+        wb = Workbook()
+        ws = wb.active
+        for row in source_ws.iter_rows(max_row=max(SAVE_ESTIMATE_LOAD_ROWS, sample_rows + 1), values_only=True):
+            ws.append(row)
+        # Vain luku -tilassa mitat luetaan tiedoston dimension-tiedosta, joka voi puuttua
+        offer_rows = source_ws.max_row or total_rows + 1
+        offer_cols = source_ws.max_column or ws.max_column
+    finally:
+        source.close()
+    copy_seconds = time.monotonic() - started
+    load_scale = offer_rows / ws.max_row if ws.max_row else 0
+    if ws.max_row > sample_rows + 1:
+        ws.delete_rows(sample_rows + 2, ws.max_row - sample_rows - 1)
+    copied_rows = ws.max_row
+
+    original_cols = {cell.value for cell in ws[1]}
+    new_columns = [col for col in config.selected_columns if col not in original_cols] + ['used_code']
+    start_col = offer_cols + 1
+
+    started = time.monotonic()
+    processor.add_new_columns(ws, result, new_columns, start_col)
+    processor.style_new_columns(ws, start_col, len(new_columns), result.matched.tolist())
+    write_seconds = time.monotonic() - started
+    processor.set_uniform_column_width(ws, 25)
+    processor.style_header_row(ws)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        started = time.monotonic()
+        wb.save(Path(temp_dir) / "dry_run.xlsx")
+        save_seconds = time.monotonic() - started
+
+    row_scale = total_rows / sample_rows if sample_rows else 0
+    written_cells = copied_rows * offer_cols + sample_rows * len(new_columns)
+    cell_scale = (offer_rows * offer_cols + total_rows * len(new_columns)) / written_cells if written_cells else 1
+    return copy_seconds * load_scale + write_seconds * row_scale + save_seconds * cell_scale
+
+
+class MatchResult:
+    """
+    Yhdistämisen tulos tiiviinä taulukkona: tarjousrivin paikka -> viiterivin paikka (-1 = ei osumaa),
+    osuman vaihe ja käytetty koodi. Viitesarakkeiden arvot haetaan vasta tarvittaessa (column_values)
+    siitä indeksin datasta, joka oli voimassa haun päättyessä, joten tarjous- tai viitedataa ei kopioida
+    tulokseen eikä myöhempi apply_delta muuta jo saatua tulosta. version kertoo tuon datan version.
+    """
+
+    def __init__(self, index, positions, tiers, used_codes, skipped_for_time=0, tier_seconds=None, tier_attempts=None,
+                 build_seconds=None):
+        self.index = index
+        self.df, self.version_stamp = index.snapshot()
+        self.table = pd.DataFrame({
+            "ref_position": positions,
+            "tier": pd.Categorical(tiers, categories=MATCH_TIERS),
+            "used_code": used_codes,
+        })
+        self.skipped_for_time = skipped_for_time
+        # Vaihekohtaiset kestot sekunteina ja vaiheeseen päätyneiden rivien määrät
+        self.tier_seconds = tier_seconds or {}
+        self.tier_attempts = tier_attempts or {}
+        # Osa vaiheen kestosta, joka kului ehdokasryhmien kertaluonteiseen rakentamiseen
+        self.build_seconds = build_seconds or {}
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def version(self):
+        if self.version_stamp is None:
+            self.version_stamp = content_version(self.df)
+        return self.version_stamp
+
+    @property
+    def positions(self):
+        return self.table["ref_position"].to_numpy()
+
+    @property
+    def matched(self):
+        return self.positions >= 0
+
+    @property
+    def used_codes(self):
+        return self.table["used_code"].to_numpy()
+
+    def column_values(self, column):
+        """
+        Palauttaa viitesarakkeen arvot tarjousrivien järjestyksessä (NaN yhdistämättömille riveille).
+        """
+        return self.df[column].reindex(self.positions).to_numpy()
+
+
 class ExcelProcessor:
     def __init__(self):
         # Alustetaan viite- ja tarjousten avainsarakkeet
@@ -17,220 +1109,103 @@ class ExcelProcessor:
         self.offer_key_column = None
         # Lista sarakkeista, jotka halutaan ottaa mukaan yhdistämisessä
         self.selected_ref_columns = []
+        # Yhdistelmäavaimen komponentti (indeksi), johon etuliite- ja fuzzy-vaiheet kohdistuvat
+        self.match_component = 0
+        # Aikarajat sekunteina koko haulle ja fuzzy-vaiheelle (None = ei rajaa)
+        self.time_budget = None
+        self.fuzzy_time_budget = None
+        # Edellisessä ajossa aikarajan vuoksi yhdistämättä jääneiden rivien määrä
+        self.skipped_for_time = 0
+
+    def build_config(self):
+        """
+        Muodostaa prosessorin asetuksista muuttumattoman MatchConfig-olion.
+        Viiteavainsarakkeet jätetään pois valituista sarakkeista muuttamatta alkuperäistä listaa.
+        """
+        return MatchConfig(
+            ref_key_columns=self.ref_key_column,
+            offer_key_columns=self.offer_key_column,
+            selected_columns=tuple(self.selected_ref_columns),
+            match_component=self.match_component,
+            time_budget=self.time_budget,
+            fuzzy_time_budget=self.fuzzy_time_budget,
+        )
 
     def process_files(self, reference_file, offer_file, reference_column, competitor_column):
         """
         Päämetodi, joka suorittaa tiedostojen prosessoinnin ja yhdistämisen.
+        Avainsarakkeet voivat olla yksittäisiä sarakkeita tai listoja (yhdistelmäavain).
         """
         self.ref_key_column = reference_column
         self.offer_key_column = competitor_column
+        config = self.build_config()
 
-        # Varmistetaan, ettei viiteavainsarake ole mukana käyttäjän valituissa sarakkeissa
-        if self.ref_key_column in self.selected_ref_columns:
-            self.selected_ref_columns.remove(self.ref_key_column)
-            logging.info(f"Removed reference key column '{self.ref_key_column}' from selected columns.")
-
-        # Ladataan ja valmistellaan tiedostot
-        df_reference, df_offer = self.load_and_prepare_files(reference_file, offer_file)
-        # Suoritetaan tiedostojen yhdistäminen
-        merged_df = self.merge_data(df_reference, df_offer)
-        # Tallennetaan yhdistetty data uuteen Excel-tiedostoon
-        output_path, missing_count = self.save_to_excel(offer_file, merged_df)
+        # Ladataan viitetiedosto ja rakennetaan siitä hakuindeksi
+        df_reference = read_reference(reference_file, config)
+        index = ReferenceIndex(df_reference, config.ref_key_columns, config.match_component)
+        # Suoritetaan yhdistäminen ja tallennetaan tulos uuteen Excel-tiedostoon
+        output_path, missing_count, result = process_offer(index, offer_file, config)
+        self.skipped_for_time = result.skipped_for_time
         logging.info(f"Processing complete. Output saved to '{output_path}'. Missing count: {missing_count}")
         return output_path, missing_count
 
+    def dry_run(self, reference_file, offer_file, reference_column, competitor_column, sample_size=200):
+        """
+        Koeajo valituilla sarakkeilla: arvioi osumaosuudet ja keston otoksen perusteella
+        (ks. dry_run-funktio). Tiedostoja ei kirjoiteta.
+        """
+        self.ref_key_column = reference_column
+        self.offer_key_column = competitor_column
+        return dry_run(reference_file, offer_file, self.build_config(), sample_size)
+
     def load_and_prepare_files(self, reference_file, offer_file):
         """
         Lataa Excel-tiedostot Pandas DataFrameihin ja tarkistaa, että tarvittavat sarakkeet ovat olemassa.
+        Tarjoustiedostosta luetaan vain avainsarakkeet, sillä tulos kirjoitetaan alkuperäiseen työkirjaan.
         """
-        try:
-            df_reference = pd.read_excel(reference_file, dtype=str)
-            logging.info(f"Reference file '{reference_file}' loaded successfully.")
-        except Exception as e:
-            logging.error(f"Could not read the reference file: {e}")
-            raise ValueError(f"Could not read the reference file: {e}")
-
-        try:
-            df_offer = pd.read_excel(offer_file, dtype=str)
-            logging.info(f"Offer file '{offer_file}' loaded successfully.")
-        except Exception as e:
-            logging.error(f"Could not read the offer file: {e}")
-            raise ValueError(f"Could not read the offer file: {e}")
-
-        # Tarkistetaan, että viiteavaimesarake löytyy viitetiedostosta
-        if self.ref_key_column not in df_reference.columns:
-            logging.error(f"Chosen reference key '{self.ref_key_column}' not found in reference file.")
-            raise ValueError(f"Chosen reference key '{self.ref_key_column}' not found in reference file.")
-        # Tarkistetaan, että tarjousavaimesarake löytyy tarjoustiedostosta
-        if self.offer_key_column not in df_offer.columns:
-            logging.error(f"Chosen offer key '{self.offer_key_column}' not found in offer file.")
-            raise ValueError(f"Chosen offer key '{self.offer_key_column}' not found in offer file.")
-
-        # Tarkistetaan, että käyttäjän valitsemat sarakkeet löytyvät viitetiedostosta
-        for col in self.selected_ref_columns:
-            if col not in df_reference.columns:
-                logging.error(f"Selected column '{col}' not in reference file.")
-                raise ValueError(f"Selected column '{col}' not in reference file.")
-        
+        config = self.build_config()
+        df_reference = read_reference(reference_file, config)
+        df_offer = read_offer_keys(offer_file, config)
         return df_reference, df_offer
 
     def merge_data(self, df_reference, df_offer):
         """
-        Yhdistää viite- ja tarjoustiedot useilla eri strategioilla.
+        Yhdistää viite- ja tarjoustiedot useilla eri strategioilla. Palauttaa MatchResult-tuloksen.
         """
-        # 1) Poistetaan duplikaatit viitetiedostosta viiteavaimen perusteella
-        df_reference = df_reference.drop_duplicates(subset=[self.ref_key_column], keep="first").copy()
-        logging.info(f"Deduplicated reference data based on '{self.ref_key_column}'.")
+        # Rakennetaan viitedatasta hakuindeksi (duplikaatit poistetaan avaimen perusteella)
+        index = ReferenceIndex(df_reference, self.ref_key_column, self.match_component)
+        return self.merge_with_index(index, df_offer)
 
-        # 2) Poistetaan välilyönnit ja trimmaillaan tarjousavaimen arvot
-        df_offer[self.offer_key_column] = df_offer[self.offer_key_column].str.replace(" ", "").str.strip()
-        logging.info(f"Removed spaces and stripped offer key column '{self.offer_key_column}'.")
-
-        # 3) Säilytetään tarjoustiedoston alkuperäinen rivijärjestys
-        df_offer["_original_order"] = range(len(df_offer))
+    def merge_with_index(self, index, df_offer):
+        """
+        Yhdistää tarjoustiedot valmiiksi rakennettuun hakuindeksiin. Samaa indeksiä voidaan
+        käyttää useissa ajoissa, jolloin viitedataa ei tarvitse ladata ja käsitellä uudelleen.
+        Käsittelee vain tarjouksen avainsarakkeet ja palauttaa tiiviin MatchResult-tuloksen.
+        """
+        result = match_offer(index, df_offer, self.build_config())
+        self.skipped_for_time = result.skipped_for_time
+        return result
 
-        # Määritellään yhdistettävät sarakkeet; jos käyttäjä on valinnut lisäsarakkeita, otetaan ne mukaan
-        if self.selected_ref_columns:
-            columns_to_merge = [self.ref_key_column] + self.selected_ref_columns
-        else:
-            columns_to_merge = [self.ref_key_column]
-
-        # 4) Uudelleennimetään viitetiedoston sarakkeet, jos tarjoustiedostossa on samannimisiä sarakkeita
-        rename_dict = {col: f"{col} (referenssi)" for col in columns_to_merge if col in df_offer.columns}
-        df_reference.rename(columns=rename_dict, inplace=True)
-        logging.info(f"Renamed columns in reference data: {rename_dict}")
-        columns_to_merge = [rename_dict.get(col, col) for col in columns_to_merge]
-
-        # 5) Suoritetaan ensimmäinen yhdistys Pandas merge-toiminnolla
-        merged_df = pd.merge(
-            df_offer,
-            df_reference[columns_to_merge],
-            left_on=self.offer_key_column,
-            right_on=columns_to_merge[0],
-            how="left",
-            sort=False,
-            indicator=True  # Lisää '_merge' sarakkeen, joka kertoo yhdistämisen tuloksen
-        )
-        logging.info("Performed initial merge.")
-
-        # Alustetaan 'used_code'-sarake, joka säilyttää alkuperäisen tarjousavaimen
-        merged_df['used_code'] = merged_df[self.offer_key_column]
-
-        # 6) Ensimmäinen vaihtoehtoinen strategia: yritetään yhdistää lisäämällä tarjousavaimeen eteen '0'
-        unmatched = merged_df['_merge'] == 'left_only'
-        if unmatched.any():
-            logging.info(f"Found {unmatched.sum()} unmatched records. Attempting match with a leading '0'.")
-            df_unmatched = df_offer.loc[unmatched].copy()
-            df_unmatched[self.offer_key_column] = '0' + df_unmatched[self.offer_key_column].astype(str)
-            merged_unmatched = pd.merge(
-                df_unmatched,
-                df_reference[columns_to_merge],
-                left_on=self.offer_key_column,
-                right_on=columns_to_merge[0],
-                how="left",
-                sort=False,
-                indicator=True
-            )
-            logging.info("Performed secondary merge with leading '0'.")
-            unmatched_indices = merged_df[unmatched].index
-            for idx, (_, row) in zip(unmatched_indices, merged_unmatched.iterrows()):
-                if row['_merge'] == 'both':
-                    # Päivitetään yhdistetyn DataFrame:n tiedot, jos löytyy osuma
-                    for col in columns_to_merge:
-                        merged_df.at[idx, col] = row[col]
-                    merged_df.at[idx, '_merge'] = 'both'
-                    merged_df.at[idx, 'used_code'] = row[self.offer_key_column]
-
-        # 7) Toinen vaihtoehtoinen strategia: yritetään etuliitteen mukaista vertailua
-        still_unmatched = merged_df['_merge'] == 'left_only'
-        if still_unmatched.any():
-            logging.info(f"{still_unmatched.sum()} records still unmatched. Trying alternative prefix matching.")
-            for idx in merged_df[still_unmatched].index:
-                offer_code = merged_df.at[idx, self.offer_key_column]
-                alt_match = self.find_alternative_match(offer_code, df_reference[self.ref_key_column])
-                if alt_match is not None:
-                    # Etsitään viiterivi, jossa siivotut arvot vastaavat toisiaan
-                    ref_row = df_reference[
-                        df_reference[self.ref_key_column].str.replace(" ", "").str.strip().str.lower() == alt_match
-                    ]
-                    if not ref_row.empty:
-                        for col in columns_to_merge:
-                            merged_df.at[idx, col] = ref_row.iloc[0][col]
-                        merged_df.at[idx, '_merge'] = 'both'
-                        merged_df.at[idx, 'used_code'] = alt_match
-
-        # 8) Kolmas vaihtoehtoinen strategia: käytetään fuzzy matching -menetelmää
-        still_unmatched = merged_df['_merge'] == 'left_only'
-        if still_unmatched.any():
-            logging.info(f"{still_unmatched.sum()} records still unmatched. Trying fuzzy matching.")
-            for idx in merged_df[still_unmatched].index:
-                offer_code = merged_df.at[idx, self.offer_key_column]
-                alt_match = self.find_fuzzy_match(offer_code, df_reference[self.ref_key_column])
-                if alt_match is not None:
-                    ref_row = df_reference[
-                        df_reference[self.ref_key_column].str.replace(" ", "").str.strip().str.lower() == alt_match
-                    ]
-                    if not ref_row.empty:
-                        for col in columns_to_merge:
-                            merged_df.at[idx, col] = ref_row.iloc[0][col]
-                        merged_df.at[idx, '_merge'] = 'both'
-                        merged_df.at[idx, 'used_code'] = alt_match
-
-        # 9) Lisätään 'matched'-sarake, joka kertoo onko rivi yhdistetty, palautetaan alkuperäinen rivijärjestys
-        merged_df['matched'] = merged_df['_merge'] == 'both'
-        merged_df.sort_values("_original_order", inplace=True)
-        merged_df.drop(columns=["_merge", "_original_order"], inplace=True)
-        logging.info("Restored original row order and removed helper columns.")
-
-        return merged_df
-
-    def find_alternative_match(self, offer_code, ref_series):
-        """
-        Yrittää löytää vaihtoehtoisen matchin, jossa tarkastellaan alkiota, 
-        joka on toinen koodin alkuosa. Palauttaa siivotun version referenssikoodista, jos löytyy.
-        """
-        cleaned_offer = str(offer_code).replace(" ", "").strip().lower()
-        for ref_code in ref_series.dropna().unique():
-            cleaned_ref = str(ref_code).replace(" ", "").strip().lower()
-            if cleaned_offer.startswith(cleaned_ref) or cleaned_ref.startswith(cleaned_offer):
-                return cleaned_ref
-        return None
-
-    def find_fuzzy_match(self, offer_code, ref_series, threshold=80):
-        """
-        Käyttää fuzzy matching -menetelmää (rapidfuzz) etsimään paras mahdollinen osuma.
-        Palauttaa matchatun koodin, jos pistemäärä ylittää asetetun kynnyksen.
-        """
-        cleaned_offer = str(offer_code).replace(" ", "").strip().lower()
-        best_match = None
-        best_score = 0
-        for ref_code in ref_series.dropna().unique():
-            cleaned_ref = str(ref_code).replace(" ", "").strip().lower()
-            score = fuzz.token_sort_ratio(cleaned_offer, cleaned_ref)
-            if score > best_score:
-                best_score = score
-                best_match = cleaned_ref
-        if best_score >= threshold:
-            return best_match
-        return None
-
-    def save_to_excel(self, offer_file, merged_df):
-        """
-        Tallentaa yhdistetyn DataFrame:n takaisin Excel-tiedostoon.
+    def save_to_excel(self, offer_file, result, config=None):
+        """
+        Tallentaa yhdistämisen tuloksen (MatchResult) takaisin Excel-tiedostoon.
         Lisää uudet sarakkeet, tyylittelee ne ja tallentaa tiedoston aikaleimalla.
+        Lisättävät sarakkeet tulevat asetuksista (oletuksena prosessorin omat asetukset).
         """
+        if config is None:
+            config = self.build_config()
+
         # Ladataan alkuperäinen workbook openpyxl:lla
         wb = load_workbook(offer_file)
         ws = wb.active
         logging.info(f"Loaded workbook '{offer_file}' for saving.")
 
-        # Luetaan alkuperäiset sarakkeet tarjoustiedostosta
-        original_offer_df = pd.read_excel(offer_file, dtype=str)
-        original_cols = set(original_offer_df.columns)
+        # Luetaan alkuperäiset sarakkeet tarjoustiedoston otsikkoriviltä
+        original_cols = {cell.value for cell in ws[1]}
 
         # Määritellään lisättävät sarakkeet: käyttäjän valitsemat referenssisarakkeet, jos niitä ei ole alkuperäisessä tiedostossa
         new_columns = []
-        for col in self.selected_ref_columns:
+        for col in config.selected_columns:
             if col not in original_cols:
                 new_columns.append(col)
         # Lisätään myös 'used_code'-sarake
@@ -240,10 +1215,10 @@ class ExcelProcessor:
         start_col = ws.max_column + 1
         logging.info(f"Adding new columns starting at column {start_col}.")
 
-        matched_list = merged_df['matched'].tolist()
+        matched_list = result.matched.tolist()
 
         # Lisätään uudet sarakkeet ja täytetään niillä dataa
-        self.add_new_columns(ws, merged_df, new_columns, start_col)
+        self.add_new_columns(ws, result, new_columns, start_col)
         # Muotoillaan uudet sarakkeet (värit, reunat)
         self.style_new_columns(ws, start_col, len(new_columns), matched_list)
         # Asetetaan yhtenäinen sarakeleveys
@@ -260,16 +1235,17 @@ class ExcelProcessor:
         logging.info(f"Saved merged workbook to '{output_path}'.")
 
         # Lasketaan ja logitetaan yhdistämättömien rivien määrä
-        matched_count = merged_df['matched'].sum()  # Osumien määrä
-        total_rows = len(merged_df)
+        matched_count = int(result.matched.sum())  # Osumien määrä
+        total_rows = len(result)
         unmatched_count = total_rows - matched_count
         logging.info(f"Count of missing matches: {unmatched_count}")
 
         return output_path, unmatched_count
 
-    def add_new_columns(self, worksheet, merged_df, new_columns, start_col):
+    def add_new_columns(self, worksheet, result, new_columns, start_col):
         """
         Lisää uudet sarakkeet Excel-työkirjaan ja täyttää ne datalla.
+        Viitesarakkeiden arvot haetaan tuloksen indeksistä sarake kerrallaan vasta tässä vaiheessa.
         Jos riviä ei ole yhdistetty, asetetaan soluun teksti "Ei vastaavaa".
         """
         # Kirjoitetaan sarakeotsikot
@@ -278,19 +1254,26 @@ class ExcelProcessor:
             header_cell.value = col_name
             logging.debug(f"Added header '{col_name}' at column {i}.")
 
+        # Haetaan kirjoitettavat arvot tarjousrivien järjestyksessä
+        matched_values = result.matched
+        column_values = {
+            col_name: result.used_codes if col_name == 'used_code' else result.column_values(col_name)
+            for col_name in new_columns
+        }
+
         # Täytetään uudet sarakkeet datalla rivittäin
-        for row_idx in range(len(merged_df)):
+        for row_idx in range(len(result)):
             excel_row = row_idx + 2  # Excelissä ensimmäinen rivi on header
-            matched = merged_df['matched'].iloc[row_idx]
+            matched = matched_values[row_idx]
             for j, col_name in enumerate(new_columns, start=start_col):
                 cell = worksheet.cell(row=excel_row, column=j)
                 if col_name == 'used_code':
-                    cell.value = merged_df['used_code'].iloc[row_idx]
+                    cell.value = column_values[col_name][row_idx]
                 else:
                     if not matched:
                         cell.value = "Ei vastaavaa"
                     else:
-                        value = merged_df[col_name].iloc[row_idx]
+                        value = column_values[col_name][row_idx]
                         cell.value = value if pd.notna(value) else ""
                 # Asetetaan solun tasoitus vasemmalle ja keskitetty vertikaalisesti
                 cell.alignment = Alignment(horizontal="left", vertical="center")
@@ -0,0 +1,311 @@
+# service.py
+"""
+Paikallinen yhdistämispalvelu, joka pitää referenssikatalogien hakuindeksit muistissa.
+
+Käynnistys (katalogi muodossa nimi=tiedosto:avainsarake[,avainsarake...]):
+    python service.py --catalog tuotteet="referenssi.xlsx:Ulkoinen tunnus" --port 8765
+
+Rajapinta (JSON, vain localhost):
+    GET  /catalogs     -> ladatut katalogit
+    POST /catalogs     {"name", "reference_file", "key_columns", "match_component"}
+    POST /catalogs/delta {"name", "delta_file" tai "reference_file"}
+    POST /match        {"catalog", "codes", "columns", ...}
+    POST /match-file   {"catalog", "offer_file", "offer_key_column", "selected_columns", ...}
+
+Hakupyynnöt hyväksyvät lisäksi asetukset "fuzzy_threshold", "enabled_tiers",
+"time_budget" ja "fuzzy_time_budget".
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from logic import MATCH_TIERS, MatchConfig, ReferenceIndex, as_key_list, match_offer, process_offer, read_delta_file
+
+
+class CatalogNotFound(Exception):
+    """
+    Pyydettyä katalogia ei ole ladattu (HTTP 404).
+    """
+
+
+class CatalogRegistry:
+    """
+    Säilyttää ladatut referenssikatalogit nimen perusteella. Indeksit rakennetaan kerran
+    latauksen yhteydessä, ja hakupyynnöt käyttävät niitä sellaisenaan.
+    """
+
+    def __init__(self):
+        self.catalogs = {}
+        self.lock = threading.Lock()
+
+    def load(self, name, reference_file, key_columns, match_component=0):
+        """
+        Lataa referenssitiedoston, rakentaa sen hakuindeksin ja rekisteröi sen annetulla nimellä.
+        Saman niminen katalogi korvataan vasta, kun uusi indeksi on valmis.
+        """
+        try:
+            df_reference = pd.read_excel(reference_file, dtype=str)
+        except Exception as e:
+            logging.error(f"Could not read the reference file: {e}")
+            raise ValueError(f"Could not read the reference file: {e}")
+        for key_column in as_key_list(key_columns):
+            if key_column not in df_reference.columns:
+                raise ValueError(f"Chosen reference key '{key_column}' not found in reference file.")
+
+        index = ReferenceIndex(df_reference, key_columns, match_component)
+        index.warm_up()
+        with self.lock:
+            self.catalogs[name] = index
+        logging.info(f"Loaded catalog '{name}' from '{reference_file}' ({len(index.df)} rows).")
+        return index
+
+    def apply_delta(self, name, delta_file=None, reference_file=None):
+        """
+        Päivittää ladatun katalogin muutostiedostosta tai uudesta viitetiedostosta (vertaamalla
+        nykyiseen dataan). Palauttaa katalogin uuden versiotunnisteen.
+        """
+        index = self.get(name)
+        if delta_file:
+            upserts, removed_keys = read_delta_file(delta_file, index.key_columns)
+            return index.apply_delta(upserts, removed_keys)
+        if reference_file:
+            try:
+                df_snapshot = pd.read_excel(reference_file, dtype=str)
+            except Exception as e:
+                logging.error(f"Could not read the reference file: {e}")
+                raise ValueError(f"Could not read the reference file: {e}")
+            return index.delta_from_snapshot(df_snapshot)
+        raise ValueError("Either 'delta_file' or 'reference_file' is required.")
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.catalogs:
+                raise CatalogNotFound(f"Catalog '{name}' is not loaded.")
+            return self.catalogs[name]
+
+    def describe(self):
+        with self.lock:
+            return {
+                name: {"rows": int((~index.removed).sum()), "key_columns": index.key_columns, "version": index.version}
+                for name, index in self.catalogs.items()
+            }
+
+
+def list_field(payload, field, default=()):
+    """
+    Palauttaa pyynnön listakentän tuplena. Muu kuin lista (esim. merkkijono) hylätään,
+    jotta sitä ei pilkota yksittäisiksi merkeiksi.
+    """
+    value = payload.get(field)
+    if value is None:
+        return tuple(default)
+    if not isinstance(value, list):
+        raise ValueError(f"'{field}' must be a list.")
+    return tuple(value)
+
+
+def build_config(index, payload, offer_key_columns=None):
+    """
+    Muodostaa pyynnön kentistä muuttumattoman MatchConfig-olion ladatulle indeksille.
+    """
+    field = "selected_columns" if "selected_columns" in payload else "columns"
+    return MatchConfig(
+        ref_key_columns=index.key_columns,
+        offer_key_columns=offer_key_columns or index.key_columns,
+        selected_columns=list_field(payload, field),
+        match_component=index.match_component,
+        fuzzy_threshold=payload.get("fuzzy_threshold", 80),
+        enabled_tiers=list_field(payload, "enabled_tiers", MATCH_TIERS) or MATCH_TIERS,
+        time_budget=payload.get("time_budget"),
+        fuzzy_time_budget=payload.get("fuzzy_time_budget"),
+    )
+
+
+def match_codes(index, codes, config):
+    """
+    Hakee listan koodeja ladatusta indeksistä. Yhdistelmäavaimella jokainen koodi on lista,
+    jonka alkiot vastaavat indeksin avainsarakkeita. Palauttaa tulokset syötteen järjestyksessä
+    sekä aikarajan vuoksi ohitettujen koodien määrän.
+    """
+    if not isinstance(codes, list):
+        raise ValueError("'codes' must be a list of codes.")
+    rows = [as_key_list(code) for code in codes]
+    for row in rows:
+        if len(row) != len(index.key_columns):
+            raise ValueError(f"Code {row} does not match key columns {index.key_columns}.")
+        for value in row:
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                raise ValueError(f"Code {row} must contain only strings or numbers.")
+    df_keys = pd.DataFrame(rows, columns=list(config.offer_key_columns), dtype=object).astype(str)
+
+    result = match_offer(index, df_keys, config)
+    values = {col: result.column_values(col) for col in config.selected_columns}
+    matched = result.matched
+    used_codes = result.used_codes
+    tiers = result.table["tier"].astype(object).to_numpy()
+
+    results = []
+    for i, code in enumerate(codes):
+        row_values = {}
+        if matched[i]:
+            for col in config.selected_columns:
+                value = values[col][i]
+                row_values[col] = value if pd.notna(value) else ""
+        results.append({
+            "code": code,
+            "matched": bool(matched[i]),
+            "tier": tiers[i] if matched[i] else None,
+            "used_code": used_codes[i],
+            "values": row_values,
+        })
+    return results, result.skipped_for_time
+
+
+def match_file(index, offer_file, config):
+    """
+    Yhdistää tarjoustiedoston ladattuun indeksiin ja tallentaa tuloksen kuten käyttöliittymä.
+    Palauttaa tallennetun tiedoston polun, yhdistämättömien rivien määrän ja
+    aikarajan vuoksi ohitettujen rivien määrän.
+    """
+    output_path, missing_count, result = process_offer(index, offer_file, config)
+    return str(output_path), int(missing_count), result.skipped_for_time
+
+
+class RequestPayload(dict):
+    """
+    Pyynnön JSON-olio, jonka puuttuva pakollinen kenttä tuottaa ValueErrorin (HTTP 400).
+    """
+
+    def __missing__(self, field):
+        raise ValueError(f"Missing required field '{field}'.")
+
+
+class MatchRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON-pyyntöjen käsittelijä. Palvelin käsittelee pyynnöt omissa säikeissään;
+    jokainen ajo saa oman MatchConfig-olionsa ja käyttää jaettua indeksiä vain lukien.
+    """
+
+    registry = None
+
+    def do_GET(self):
+        if self.path == "/catalogs":
+            self.send_json(200, self.registry.describe())
+        else:
+            self.send_json(404, {"error": f"Unknown path '{self.path}'."})
+
+    def do_POST(self):
+        started = time.perf_counter()
+        try:
+            payload = self.read_json()
+            if self.path == "/catalogs":
+                index = self.registry.load(
+                    payload["name"],
+                    payload["reference_file"],
+                    payload["key_columns"],
+                    payload.get("match_component", 0),
+                )
+                response = {"name": payload["name"], "rows": len(index.df), "version": index.version}
+            elif self.path == "/catalogs/delta":
+                version = self.registry.apply_delta(
+                    payload["name"],
+                    payload.get("delta_file"),
+                    payload.get("reference_file"),
+                )
+                response = {"name": payload["name"], "version": version}
+            elif self.path == "/match":
+                index = self.registry.get(payload["catalog"])
+                results, skipped_for_time = match_codes(index, payload["codes"], build_config(index, payload))
+                response = {"results": results, "skipped_for_time": skipped_for_time}
+            elif self.path == "/match-file":
+                index = self.registry.get(payload["catalog"])
+                config = build_config(index, payload, payload["offer_key_column"])
+                output_path, missing_count, skipped_for_time = match_file(index, payload["offer_file"], config)
+                response = {
+                    "output_path": output_path,
+                    "missing_count": missing_count,
+                    "skipped_for_time": skipped_for_time,
+                }
+            else:
+                self.send_json(404, {"error": f"Unknown path '{self.path}'."})
+                return
+        except CatalogNotFound as e:
+            self.send_json(404, {"error": str(e)})
+            return
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            logging.exception(f"Request to '{self.path}' failed.")
+            self.send_json(500, {"error": f"Internal error: {e}"})
+            return
+        response["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        self.send_json(200, response)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}")
+        if not isinstance(payload, dict):
+            raise ValueError("Request body must be a JSON object.")
+        return RequestPayload(payload)
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} - {format % args}")
+
+
+def parse_catalog_arg(value):
+    """
+    Jäsentää komentoriviargumentin muotoa nimi=tiedosto:avainsarake[,avainsarake...].
+    """
+    try:
+        name, rest = value.split("=", 1)
+        reference_file, keys = rest.rsplit(":", 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Catalog '{value}' must be of the form name=file:key[,key...]")
+    key_columns = keys.split(",")
+    return name, reference_file, key_columns if len(key_columns) > 1 else key_columns[0]
+
+
+def serve(registry, host="127.0.0.1", port=8765):
+    """
+    Käynnistää palvelimen ja palvelee pyyntöjä, kunnes prosessi pysäytetään.
+    """
+    handler = type("BoundMatchRequestHandler", (MatchRequestHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    logging.info(f"Matching service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Paikallinen yhdistämispalvelu.")
+    parser.add_argument("--catalog", action="append", default=[], type=parse_catalog_arg,
+                        help="Ladattava katalogi muodossa nimi=tiedosto:avainsarake[,avainsarake...]")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    registry = CatalogRegistry()
+    for name, reference_file, key_columns in args.catalog:
+        registry.load(name, reference_file, key_columns)
+    serve(registry, args.host, args.port)
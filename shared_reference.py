@@ -0,0 +1,228 @@
+# shared_reference.py
+"""
+Referenssi-indeksin jakaminen työprosesseille muistiin kartoitetun Arrow IPC -tiedoston kautta.
+
+Pääprosessi kirjoittaa deduplikoidun viitedatan, sen hajautusarvot, siivotut vertailukoodit ja
+etuliite- ja fuzzy-vaiheiden ehdokastaulun kerran tiedostoon (export_index). Työprosessit liittävät
+tiedoston muistiin (attach_index) kopioimatta sitä, jolloin käyttöjärjestelmä jakaa samat
+muistisivut kaikkien prosessien kesken, eikä työprosessien tarvitse laskea hajautusarvoja,
+siivota koodeja tai rakentaa ehdokasryhmiä uudelleen.
+
+Siivotut koodit tallennetaan kiinteän levyisinä UTF-32-arvoina, jotta ne voidaan lukea suoraan
+NumPy-merkkijonotaulukkoina ('<U'-tyyppi) ilman Python-olioita.
+
+Vaatii pyarrow-kirjaston (pip install pyarrow).
+"""
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from logic import ReferenceIndex
+
+KEY_HASH_COLUMN = "__key_hash__"
+GROUP_HASH_COLUMN = "__group_hash__"
+CLEAN_CODE_COLUMN = "__clean_code__"
+CANDIDATE_GROUP_COLUMN = "__candidate_group__"
+CANDIDATE_CODE_COLUMN = "__candidate_code__"
+CANDIDATE_POSITION_COLUMN = "__candidate_position__"
+HIDDEN_COLUMNS = (
+    KEY_HASH_COLUMN, GROUP_HASH_COLUMN, CLEAN_CODE_COLUMN,
+    CANDIDATE_GROUP_COLUMN, CANDIDATE_CODE_COLUMN, CANDIDATE_POSITION_COLUMN,
+)
+METADATA_KEY = b"excel_matcher"
+
+# Prosessikohtaisesti liitetyt indeksit tiedostopolun mukaan: polku -> (muokkausaika, indeksi)
+ATTACHED_INDEXES = {}
+
+
+def import_pyarrow():
+    """
+    Tuo pyarrow-kirjaston vasta tarvittaessa ja antaa selkeän virheen, jos sitä ei ole asennettu.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc  # noqa: F401
+    except ImportError:
+        raise ImportError("Shared reference data requires pyarrow. Install it with 'pip install pyarrow'.")
+    return pa
+
+
+def fixed_width_array(pa, codes, width, present=None):
+    """
+    Muuntaa merkkijonot kiinteän levyiseksi UTF-32-sarakkeeksi (pa.binary(4 * width)).
+    present-maskin ulkopuoliset rivit merkitään puuttuviksi.
+    """
+    data = np.asarray(codes, dtype=f"<U{width}")
+    validity = None
+    if present is not None and not present.all():
+        validity = pa.array(present, type=pa.bool_()).buffers()[1]
+    return pa.Array.from_buffers(pa.binary(4 * width), len(data), [validity, pa.py_buffer(data)])
+
+
+def candidate_table(index, live):
+    """
+    Laskee voimassa olevien rivien ehdokastaulun: jokaisen ryhmän jokaiselle siivotulle koodille
+    pienin rivin paikka, järjestettynä ryhmän ja koodin mukaan. Paikat ovat rivien paikkoja
+    kirjoitettavassa (poistetuista riveistä tiivistetyssä) datassa.
+
+    Palauttaa rivien siivotut koodit (puuttuvat tyhjinä), maskin riveistä, joilla koodi on,
+    ja ehdokastaulun (ryhmät, koodit, paikat).
+    """
+    rows = np.flatnonzero(live)
+    present = index.code_mask(rows)
+    codes = np.where(present, index.build_cleaned_codes()[rows], "").astype(str)
+    positions = np.flatnonzero(present)
+    groups = index.build_group_hash()[rows][positions]
+    group_codes = codes[positions]
+
+    order = np.lexsort((positions, group_codes, groups))
+    groups, group_codes, positions = groups[order], group_codes[order], positions[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (groups[1:] != groups[:-1]) | (group_codes[1:] != group_codes[:-1])
+    return codes, present, (groups[first], group_codes[first], positions[first])
+
+
+def export_index(index, path, columns=None):
+    """
+    Kirjoittaa indeksin avainsarakkeet, valitut hyötykuormasarakkeet, hajautusarvot, siivotut
+    koodit ja ehdokastaulun Arrow IPC -tiedostoon. Jos sarakkeita ei anneta, kaikki viitedatan
+    sarakkeet kirjoitetaan. Poistetuiksi merkittyjä rivejä ei kirjoiteta; indeksin versiotunniste
+    tallennetaan metatietoihin.
+
+    Ehdokastaulu (ryhmä, koodi, paikka) on yhtä pitkä kuin data; sen rivimäärä on metatiedoissa
+    ja loput rivit ovat täytettä.
+
+    Tiedosto kirjoitetaan ensin väliaikaiseen tiedostoon samaan kansioon ja vaihdetaan paikalleen
+    vasta valmiina, joten työprosessit eivät koskaan näe puoliksi kirjoitettua tiedostoa.
+    """
+    pa = import_pyarrow()
+
+    columns = list(index.df.columns) if columns is None else list(columns)
+    for col in columns:
+        if col not in index.df.columns:
+            raise ValueError(f"Selected column '{col}' not in reference file.")
+    columns = index.key_columns + [col for col in columns if col not in index.key_columns]
+
+    live = ~index.removed
+    table = pa.Table.from_pandas(index.df.loc[live, columns], preserve_index=False)
+    table = table.append_column(KEY_HASH_COLUMN, pa.array(index.key_hash[live], type=pa.uint64()))
+    table = table.append_column(GROUP_HASH_COLUMN, pa.array(index.build_group_hash()[live], type=pa.uint64()))
+
+    codes, present, (groups, candidate_codes, positions) = candidate_table(index, live)
+    width = max(int(np.char.str_len(codes).max()) if len(codes) else 0, 1)
+    padding = len(table) - len(groups)
+    table = table.append_column(CLEAN_CODE_COLUMN, fixed_width_array(pa, codes, width, present))
+    table = table.append_column(
+        CANDIDATE_GROUP_COLUMN, pa.array(np.concatenate([groups, np.zeros(padding, dtype=np.uint64)]))
+    )
+    table = table.append_column(
+        CANDIDATE_CODE_COLUMN, fixed_width_array(pa, np.concatenate([candidate_codes, np.full(padding, "")]), width)
+    )
+    table = table.append_column(
+        CANDIDATE_POSITION_COLUMN, pa.array(np.concatenate([positions, np.full(padding, -1)]).astype(np.int64))
+    )
+    metadata = {
+        "key_columns": index.key_columns,
+        "match_component": index.match_component,
+        "version": index.version,
+        "code_width": width,
+        "candidate_count": len(groups),
+    }
+    table = table.replace_schema_metadata({METADATA_KEY: json.dumps(metadata).encode("utf-8")})
+
+    # Yksi tietue-erä, jotta sarakkeet voidaan liittää ilman yhdistämistä
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with pa.OSFile(temp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table, max_chunksize=max(len(table), 1))
+        os.replace(temp_path, str(path))
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    logging.info(f"Exported reference index ({len(table)} rows, {len(columns)} columns) to '{path}'.")
+    return path
+
+
+def column_to_numpy(column):
+    """
+    Palauttaa null-arvottoman numeerisen Arrow-sarakkeen NumPy-taulukkona ilman kopiointia.
+    """
+    if column.num_chunks == 1:
+        return column.chunk(0).to_numpy(zero_copy_only=True)
+    return column.to_numpy()
+
+
+def fixed_width_to_numpy(column, width):
+    """
+    Palauttaa fixed_width_array-funktiolla kirjoitetun sarakkeen NumPy-merkkijonotaulukkona
+    ilman kopiointia sekä maskin riveistä, joilla arvo on (None, jos arvo on kaikilla riveillä).
+    """
+    if column.num_chunks != 1:
+        column = column.combine_chunks()
+    else:
+        column = column.chunk(0)
+    if not len(column):
+        return np.array([], dtype=f"<U{width}"), None
+    codes = np.frombuffer(column.buffers()[1], dtype=f"<U{width}", count=len(column), offset=column.offset * 4 * width)
+    present = column.is_valid().to_numpy(zero_copy_only=False) if column.null_count else None
+    return codes, present
+
+
+def attach_index(path):
+    """
+    Liittää export_index-funktiolla kirjoitetun tiedoston muistiin ja palauttaa sitä käyttävän
+    ReferenceIndex-olion. Merkkijonosarakkeet jäävät Arrow-puskureihin (pd.ArrowDtype), joten
+    dataa ei kopioida prosessin muistiin. Siivotut koodit ja ehdokastaulu luetaan NumPy-näkyminä
+    samoista puskureista, joten ehdokasryhmät ovat taulun viipaleita. Sama polku liitetään prosessissa vain kerran; jos
+    tiedosto on kirjoitettu uudelleen (muokkausaika muuttunut), se liitetään uudestaan.
+    """
+    path = str(path)
+    modified = os.stat(path).st_mtime_ns
+    cached = ATTACHED_INDEXES.get(path)
+    if cached is not None and cached[0] == modified:
+        return cached[1]
+
+    pa = import_pyarrow()
+    source = pa.memory_map(path, "r")
+    table = pa.ipc.open_file(source).read_all()
+    metadata = json.loads(table.schema.metadata[METADATA_KEY].decode("utf-8"))
+
+    key_hash = column_to_numpy(table.column(KEY_HASH_COLUMN))
+    group_hash = column_to_numpy(table.column(GROUP_HASH_COLUMN))
+    width = metadata["code_width"]
+    cleaned_codes, codes_present = fixed_width_to_numpy(table.column(CLEAN_CODE_COLUMN), width)
+    count = metadata["candidate_count"]
+    candidates = (
+        column_to_numpy(table.column(CANDIDATE_GROUP_COLUMN))[:count],
+        fixed_width_to_numpy(table.column(CANDIDATE_CODE_COLUMN), width)[0][:count],
+        column_to_numpy(table.column(CANDIDATE_POSITION_COLUMN))[:count],
+    )
+    payload = table.select([name for name in table.column_names if name not in HIDDEN_COLUMNS])
+    df = payload.to_pandas(types_mapper=pd.ArrowDtype)
+
+    index = ReferenceIndex.from_prepared(
+        df,
+        metadata["key_columns"],
+        metadata["match_component"],
+        key_hash,
+        group_hash,
+        metadata.get("version"),
+        cleaned_codes,
+        codes_present,
+        candidates,
+    )
+    ATTACHED_INDEXES[path] = (modified, index)
+    logging.info(f"Attached shared reference index '{path}' ({len(df)} rows).")
+    return index
+
+
+def init_worker(path):
+    """
+    Työprosessien alustusfunktio, esim. multiprocessing.Pool(initializer=init_worker, initargs=(path,)).
+    """
+    attach_index(path)
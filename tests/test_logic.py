@@ -0,0 +1,155 @@
+import random
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz
+
+import logic
+from logic import CandidateGroup, MatchConfig, ReferenceIndex, clean_code, match_offer
+
+
+def test_composite_key_matches_with_space_in_other_component():
+    df_reference = pd.DataFrame({
+        "code": ["A1", "B2"],
+        "mfr": ["Acme Oy", "10 kpl"],
+        "name": ["first", "second"],
+    })
+    df_offer = pd.DataFrame({"tuote": ["A 1", "B2", "B2x"], "valmistaja": ["Acme Oy", "10 kpl", "10 kpl"]})
+    index = ReferenceIndex(df_reference, ["code", "mfr"])
+    config = MatchConfig(["code", "mfr"], ["tuote", "valmistaja"], ("name",))
+
+    result = match_offer(index, df_offer, config)
+
+    assert result.positions.tolist() == [0, 1, 1]
+    assert result.table["tier"].tolist() == ["exact", "exact", "prefix"]
+    assert result.column_values("name").tolist() == ["first", "second", "second"]
+
+
+def test_delta_updates_matches_and_keeps_old_results():
+    index = ReferenceIndex(pd.DataFrame({"code": ["A1", "B2", "C3"], "name": ["a", "b", "c"]}), "code")
+    index.warm_up()
+    config = MatchConfig("code", "code", ("name",))
+    df_offer = pd.DataFrame({"code": ["A1", "B2", "D4", "b2x"]})
+    before = match_offer(index, df_offer, config)
+
+    index.apply_delta(pd.DataFrame({"code": ["A1", "D4"], "name": ["aa", "d"]}), pd.DataFrame({"code": ["B2"]}))
+    after = match_offer(index, df_offer, config)
+
+    assert before.column_values("name").tolist()[:2] == ["a", "b"]
+    assert before.version != after.version == index.version
+    assert after.positions.tolist() == [0, -1, 3, -1]
+    assert after.column_values("name").tolist()[0] == "aa"
+
+    # Palautettu rivi palaa myös etuliite-ehdokkaaksi
+    index.apply_delta(pd.DataFrame({"code": ["B2"], "name": ["bb"]}))
+    assert match_offer(index, df_offer, config).positions.tolist() == [0, 1, 3, 1]
+
+
+def test_lazy_build_does_not_race_with_delta(monkeypatch):
+    index = ReferenceIndex(pd.DataFrame({"code": ["A1", "B2"]}), "code")
+    started = threading.Event()
+    original = logic.clean_codes
+
+    def slow_clean_codes(values):
+        started.set()
+        time.sleep(0.2)
+        return original(values)
+
+    monkeypatch.setattr(logic, "clean_codes", slow_clean_codes)
+    builder = threading.Thread(target=index.build_cleaned_codes)
+    builder.start()
+    started.wait()
+    index.apply_delta(pd.DataFrame({"code": ["C3"]}))
+    builder.join()
+
+    assert len(index.build_cleaned_codes()) == len(index.df) == 3
+    assert index.find_prefix("c3x", 0) == ("c3", 2)
+
+
+def brute_force_candidates(index, group):
+    """
+    Ryhmän voimassa olevat (siivottu koodi, paikka) -parit rivijärjestyksessä ilman välimuisteja.
+    """
+    groups = index.group_keys(index.df, index.other_columns)
+    return [
+        (clean_code(value), pos)
+        for pos, value in enumerate(index.df[index.match_column])
+        if groups[pos] == group and not index.removed[pos] and not pd.isna(value)
+    ]
+
+
+def test_candidate_groups_follow_random_deltas():
+    rng = random.Random(7)
+
+    def random_code():
+        return "".join(rng.choice("ab1 2") for _ in range(rng.randint(1, 4)))
+
+    df_reference = pd.DataFrame({"code": [random_code() for _ in range(150)], "mfr": [rng.choice("xy") for _ in range(150)]})
+    index = ReferenceIndex(df_reference, ["code", "mfr"])
+    index.warm_up()
+
+    for _ in range(15):
+        live = index.live_data()
+        removed_keys = live.sample(n=min(5, len(live)), random_state=rng.randrange(1000))[["code", "mfr"]]
+        upserts = pd.DataFrame({"code": [random_code() for _ in range(5)], "mfr": [rng.choice("xy") for _ in range(5)]})
+        # Mukaan myös aiemmin poistettuja avaimia, jotka palautetaan
+        upserts = pd.concat([upserts, index.df[index.removed].head(2)[["code", "mfr"]]], ignore_index=True)
+        index.apply_delta(upserts, removed_keys)
+
+        for group in index.build_groups():
+            expected = brute_force_candidates(index, group)
+            for offer in [random_code() for _ in range(20)]:
+                cleaned = clean_code(offer)
+                prefix = next(((c, p) for c, p in expected if cleaned.startswith(c) or c.startswith(cleaned)), None)
+                assert index.find_prefix(offer, group) == prefix
+
+                best, best_score = None, 0
+                for code, pos in expected:
+                    score = fuzz.token_sort_ratio(cleaned, code)
+                    if score > best_score:
+                        best, best_score = (code, pos), score
+                assert index.find_fuzzy(offer, group, 60) == (best if best_score >= 60 else None)
+
+
+def test_candidate_group_reads_during_updates():
+    group = CandidateGroup.from_rows(np.array(["a1", "b2", "c3"], dtype=object), np.array([0, 1, 2]))
+    stop = threading.Event()
+    results = set()
+
+    def reader():
+        while not stop.is_set():
+            results.add(group.find_prefix("b2x"))
+
+    threads = [threading.Thread(target=reader) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for i in range(2000):
+        group.set_representatives({f"z{i}": 10 + i, "b2": 1 if i % 2 else 5})
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    assert results <= {("b2", 1), ("b2", 5)}
+    assert group.find_prefix("b2x") == ("b2", 1)
+    assert len(group) == 2003
+
+
+def test_save_estimate_reads_offer_in_read_only_mode(tmp_path, monkeypatch):
+    offer_file = tmp_path / "offer.xlsx"
+    pd.DataFrame({"tuote": [f"C{i}" for i in range(50)], "other": range(50)}).to_excel(offer_file, index=False)
+    index = ReferenceIndex(pd.DataFrame({"code": ["C1", "C2"], "name": ["a", "b"]}), "code")
+    config = MatchConfig("code", "tuote", ("name",))
+    result = match_offer(index, pd.DataFrame({"tuote": ["C1", "zz"]}), config)
+    modes = []
+    original = logic.load_workbook
+
+    def recording_load_workbook(filename, read_only=False, **kwargs):
+        modes.append(read_only)
+        return original(filename, read_only=read_only, **kwargs)
+
+    monkeypatch.setattr(logic, "load_workbook", recording_load_workbook)
+
+    assert logic.estimate_save_seconds(offer_file, result, config, 50) > 0
+    assert modes == [True]
@@ -0,0 +1,67 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+import service
+from logic import ReferenceIndex
+from service import CatalogRegistry, MatchRequestHandler
+
+
+@pytest.fixture
+def post():
+    registry = CatalogRegistry()
+    registry.catalogs["cat"] = ReferenceIndex(pd.DataFrame({"code": ["A1", "B2"], "name": ["a", "b"]}), "code")
+    handler = type("Handler", (MatchRequestHandler,), {"registry": registry})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def send(path, data):
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{server.server_address[1]}{path}", json.dumps(data).encode("utf-8"), method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    yield send
+    server.shutdown()
+    server.server_close()
+
+
+def test_match_returns_selected_columns(post):
+    status, body = post("/match", {"catalog": "cat", "codes": ["A1", "zz"], "columns": ["name"]})
+    assert status == 200
+    assert [row["values"] for row in body["results"]] == [{"name": "a"}, {}]
+
+
+def test_unknown_catalog_is_404(post):
+    status, body = post("/match", {"catalog": "nope", "codes": []})
+    assert status == 404
+    assert body["error"] == "Catalog 'nope' is not loaded."
+
+
+@pytest.mark.parametrize("payload", [
+    {"codes": "A1"},
+    {"codes": ["A1"], "columns": "name"},
+    {"codes": ["A1"], "enabled_tiers": "exact"},
+    {"codes": ["A1"], "fuzzy_threshold": "80"},
+])
+def test_invalid_request_is_400(post, payload):
+    status, _ = post("/match", {"catalog": "cat", **payload})
+    assert status == 400
+
+
+def test_internal_key_error_is_500(post, monkeypatch):
+    def broken(*args):
+        raise KeyError("internal")
+
+    monkeypatch.setattr(service, "match_codes", broken)
+    status, _ = post("/match", {"catalog": "cat", "codes": ["A1"]})
+    assert status == 500
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import shared_reference
+from logic import MatchConfig, ReferenceIndex, match_offer
+
+
+@pytest.fixture
+def reference():
+    df_reference = pd.DataFrame({
+        "code": ["A1", "a 1", "B2", None, "B2", "C33", "Ä4"],
+        "mfr": ["x", "x", "x", "x", "y", "y", "y"],
+        "name": ["a1", "a1b", "b2x", "none", "b2y", "c3", "ä4"],
+    })
+    index = ReferenceIndex(df_reference, ["code", "mfr"])
+    index.apply_delta(removed_keys=pd.DataFrame({"code": ["A1"], "mfr": ["x"]}))
+    return index
+
+
+def attach(index, tmp_path):
+    path = tmp_path / "reference.arrow"
+    shared_reference.export_index(index, path)
+    return shared_reference.attach_index(path)
+
+
+def test_attached_index_reads_candidates_from_shared_views(reference, tmp_path):
+    attached = attach(reference, tmp_path)
+    live = ReferenceIndex(reference.live_data().reset_index(drop=True), ["code", "mfr"])
+    df_offer = pd.DataFrame({
+        "tuote": ["a1", "a1zz", "b2", "b", "c3", "ä", "zz", "b2"],
+        "valmistaja": ["x", "x", "x", "y", "y", "y", "y", "y"],
+    })
+    config = MatchConfig(["code", "mfr"], ["tuote", "valmistaja"], ("name",), fuzzy_threshold=60)
+
+    result = match_offer(attached, df_offer, config)
+
+    assert result.positions.tolist() == match_offer(live, df_offer, config).positions.tolist()
+    attached.warm_up()
+    assert attached.group_positions is None
+    for group in attached.candidate_cache.values():
+        assert isinstance(group.sorted_codes, np.ndarray) and not group.sorted_codes.flags.owndata
+        assert isinstance(group.sorted_positions, np.ndarray) and not group.sorted_positions.flags.owndata
+
+
+def test_attached_index_applies_delta(reference, tmp_path):
+    attached = attach(reference, tmp_path)
+    attached.candidates(attached.build_group_hash()[0])
+
+    attached.apply_delta(
+        pd.DataFrame({"code": ["B2", "D5"], "mfr": ["x", "z"], "name": ["b2x2", "d5"]}),
+        pd.DataFrame({"code": ["a 1", "C33"], "mfr": ["x", "y"]}),
+    )
+
+    group_x, group_y = attached.build_group_hash()[[0, 3]]
+    assert attached.find_prefix("a1", group_x) is None
+    assert attached.find_prefix("b2", group_x) == ("b2", 1)
+    assert attached.find_prefix("c3", group_y) is None
+    assert attached.find_prefix("ä4", group_y) == ("ä4", 5)
+    assert attached.find_prefix("d5x", attached.build_group_hash()[-1]) == ("d5", len(attached.df) - 1)
@@ -3,19 +3,26 @@ import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
 import tkinter as tk
 from tkinter import filedialog, messagebox
-import pandas as pd
 import os
 import subprocess
 import platform
+import threading
+
+
+def warm_up_imports():
+    """
+    Tuo raskaat kirjastot (pandas, openpyxl, rapidfuzz) taustalla, jotta ikkuna
+    aukeaa heti ja ensimmäinen tiedostovalinta ei joudu odottamaan tuontia.
+    """
+    import logic  # noqa: F401
 
-from logic import ExcelProcessor
 
 class ExcelMatcherApp:
     """
     Updated GUI that lets the user pick:
-      - reference key column
+      - reference key column (plus optional extra key columns for a composite key)
       - multiple reference columns to copy
-      - offer key column
+      - offer key column (plus optional extra key columns for a composite key)
     """
 
     def __init__(self):
@@ -53,9 +60,15 @@ class ExcelMatcherApp:
 
         # We'll store the user-selected reference columns in here
         self.selected_reference_columns = []
+        # Extra key columns of a composite key, in the order the user picked them
+        self.ref_extra_keys = []
+        self.offer_extra_keys = []
 
-        # Our core logic object
-        self.processor = ExcelProcessor()
+        # Our core logic object, created on first use so that logic.py is not imported at startup
+        self.processor = None
+
+        # Warm up the heavy imports while the user is picking files
+        threading.Thread(target=warm_up_imports, daemon=True).start()
 
         self.master.mainloop()
 
@@ -113,6 +126,9 @@ class ExcelMatcherApp:
         self.ref_column_menu.pack(pady=5, padx=5, anchor="w")
         self.ref_column_menu.bind("<<ComboboxSelected>>", self.on_reference_column_selected)
 
+        # Yhdistelmäavaimen lisäsarakkeet (valinnainen)
+        self.ref_extra_keys_listbox = self.build_extra_keys_chooser(self.step1_frame, self.on_ref_extra_keys_selected)
+
         # A new label for user-chosen columns
         lbl2 = ttk.Label(
             self.step1_frame, 
@@ -163,6 +179,31 @@ class ExcelMatcherApp:
             bootstyle="secondary"
         )
         self.offer_column_menu.pack(pady=5, padx=5, anchor="w")
+        self.offer_column_menu.bind("<<ComboboxSelected>>", self.on_offer_column_selected)
+
+        # Yhdistelmäavaimen lisäsarakkeet (valinnainen)
+        self.offer_extra_keys_listbox = self.build_extra_keys_chooser(self.step2_frame, self.on_offer_extra_keys_selected)
+
+    def build_extra_keys_chooser(self, frame, command):
+        """
+        Luo monivalintalistan yhdistelmäavaimen lisäsarakkeille. Etuliite- ja fuzzy-vertailu
+        kohdistuu aina pääsarakkeeseen; lisäsarakkeiden on täsmättävä sellaisenaan.
+        """
+        lbl = ttk.Label(
+            frame,
+            text="Lisäavainsarakkeet (valinnainen, esim. valmistajan koodi), valintajärjestyksessä:"
+        )
+        lbl.pack(anchor="w", padx=5, pady=(10, 0))
+
+        listbox = tk.Listbox(
+            frame,
+            selectmode=tk.MULTIPLE,
+            height=4,
+            exportselection=False
+        )
+        listbox.pack(pady=5, padx=5, fill=tk.X)
+        listbox.bind('<<ListboxSelect>>', command)
+        return listbox
 
     def build_save_location_section(self):
         self.save_frame = ttk.Labelframe(
@@ -215,6 +256,16 @@ class ExcelMatcherApp:
         )
         self.process_button.pack(side=LEFT, padx=(0, 10), ipadx=10, ipady=5)
 
+        # "Koeajo" nappi: arvioi keston ja osumat otoksella ennen varsinaista ajoa
+        self.dry_run_button = ttk.Button(
+            buttons_frame,
+            text="Koeajo",
+            bootstyle="primary-outline",
+            command=self.start_dry_run,
+            state=tk.DISABLED
+        )
+        self.dry_run_button.pack(side=LEFT, padx=(0, 10), ipadx=10, ipady=5)
+
         # "Ohjeet" nappi
         help_button = ttk.Button(
             buttons_frame, 
@@ -234,6 +285,23 @@ class ExcelMatcherApp:
         )
         self.progress_bar.pack(pady=5)
 
+    def read_excel(self, path):
+        """
+        Lukee Excel-tiedoston DataFrameksi. Pandas tuodaan vasta tässä, jotta
+        käynnistys ei odota sen latautumista.
+        """
+        import pandas as pd
+        return pd.read_excel(path, dtype=str)
+
+    def get_processor(self):
+        """
+        Palauttaa ExcelProcessor-olion ja luo sen ensimmäisellä kutsulla.
+        """
+        if self.processor is None:
+            from logic import ExcelProcessor
+            self.processor = ExcelProcessor()
+        return self.processor
+
     # -----------------------------
     #         UI Callbacks
     # -----------------------------
@@ -242,14 +310,18 @@ class ExcelMatcherApp:
             "Tämä ohjelma yhdistää tarjoustiedoston tuotteet referenssitiedostoon.\n\n\n"
             "**Vaihe 1**\n"
             "1. Valitse referenssitiedosto, jossa on ulkoiset ja sisäiset tuotetiedot.\n"
-            "2. Valitse sarake, josta löytyy ulkoiset tuotekoodit.\n"
+            "2. Valitse sarake, josta löytyy ulkoiset tuotekoodit. Jos tuote tunnistetaan vain\n"
+            "   sarakkeiden yhdistelmällä (esim. valmistaja + koodi), valitse lisäavainsarakkeet.\n"
             "3. Valitse kaikki sarakkeet, jotka haluat kopioida lopulliseen tiedostoon.\n\n\n"
             "**Vaihe 2**\n"
             "4. Valitse tarjoustiedosto.\n"
-            "5. Valitse sarake, josta löytyy ulkoiset tuotenumerot.\n\n\n"
+            "5. Valitse sarake, josta löytyy ulkoiset tuotenumerot, ja tarvittaessa samat\n"
+            "   lisäavainsarakkeet samassa järjestyksessä kuin referenssitiedostossa.\n"
+            "   Etuliite- ja fuzzy-vertailu kohdistuu tuotenumerosarakkeeseen.\n\n\n"
             "**Vaihe 3**\n"
             "6. Valitse tallennuskansio.\n"
-            "7. Klikkaa 'Aloita Prosessi'.\n"
+            "7. Halutessasi klikkaa 'Koeajo' arvioidaksesi keston ja osumat otoksella.\n"
+            "8. Klikkaa 'Aloita Prosessi'.\n"
             "Tämän jälkeen ohjelma luo uuden tiedoston valitsemaasi kansioon.\n"
             "Tiedostossa ovat vain valitsemasi sarakkeet referenssitiedostosta.\n"
         )
@@ -261,7 +333,7 @@ class ExcelMatcherApp:
         )
         if self.reference_file:
             try:
-                df_reference = pd.read_excel(self.reference_file, dtype=str)
+                df_reference = self.read_excel(self.reference_file)
                 columns = list(df_reference.columns)
 
                 # Jos sarakkeita on, aseta oletusreferenssiavaimesarake
@@ -295,10 +367,12 @@ class ExcelMatcherApp:
         # Päivitä monivalintalistasta poistamalla valittu referenssiavaimen sarake
         self.ref_cols_listbox.delete(0, tk.END)
         try:
-            df_reference = pd.read_excel(self.reference_file, dtype=str)
+            df_reference = self.read_excel(self.reference_file)
             for col in df_reference.columns:
                 if col != value:
                     self.ref_cols_listbox.insert(tk.END, col)
+            self.fill_extra_keys_listbox(self.ref_extra_keys_listbox, df_reference.columns, value)
+            self.ref_extra_keys = []
         except Exception as e:
             messagebox.showerror("Virhe", f"Virhe tiedoston lukemisessa:\n{str(e)}")
 
@@ -307,18 +381,60 @@ class ExcelMatcherApp:
     def on_columns_selected(self, event):
         self.check_ready_to_process()
 
+    def fill_extra_keys_listbox(self, listbox, columns, key_column):
+        listbox.delete(0, tk.END)
+        for col in columns:
+            if col != key_column:
+                listbox.insert(tk.END, col)
+
+    def selection_in_order(self, listbox, previous):
+        """
+        Palauttaa listan valinnat valintajärjestyksessä: aiemmin valitut säilyttävät paikkansa
+        ja uudet lisätään loppuun. Järjestys kertoo, mitkä referenssin ja tarjouksen
+        lisäavainsarakkeet vastaavat toisiaan.
+        """
+        selected = [listbox.get(i) for i in listbox.curselection()]
+        return [col for col in previous if col in selected] + [col for col in selected if col not in previous]
+
+    def on_ref_extra_keys_selected(self, event):
+        self.ref_extra_keys = self.selection_in_order(self.ref_extra_keys_listbox, self.ref_extra_keys)
+
+    def on_offer_extra_keys_selected(self, event):
+        self.offer_extra_keys = self.selection_in_order(self.offer_extra_keys_listbox, self.offer_extra_keys)
+
+    def on_offer_column_selected(self, event):
+        try:
+            df_offer = self.read_excel(self.offer_file)
+            self.fill_extra_keys_listbox(self.offer_extra_keys_listbox, df_offer.columns, self.offer_column_var.get())
+            self.offer_extra_keys = []
+        except Exception as e:
+            messagebox.showerror("Virhe", f"Virhe tiedoston lukemisessa:\n{str(e)}")
+
+    def key_columns(self):
+        """
+        Palauttaa viite- ja tarjousavaimen. Yksinkertainen avain on sarakenimi; yhdistelmäavain
+        on lista, jonka ensimmäinen sarake on etuliite- ja fuzzy-vertailun kohde.
+        """
+        ref_key = self.reference_column_var.get()
+        offer_key = self.offer_column_var.get()
+        if self.ref_extra_keys or self.offer_extra_keys:
+            return [ref_key] + self.ref_extra_keys, [offer_key] + self.offer_extra_keys
+        return ref_key, offer_key
+
     def choose_offer_file(self):
         self.offer_file = filedialog.askopenfilename(
             filetypes=[("Excel-tiedostot", "*.xlsx *.xls")]
         )
         if self.offer_file:
             try:
-                df_offer = pd.read_excel(self.offer_file, dtype=str)
+                df_offer = self.read_excel(self.offer_file)
                 columns = list(df_offer.columns)
 
                 if columns:
                     self.offer_column_var.set(columns[0])
                 self.update_offer_column_menu(columns)
+                self.fill_extra_keys_listbox(self.offer_extra_keys_listbox, columns, self.offer_column_var.get())
+                self.offer_extra_keys = []
 
                 # Lisää vihreä tarkistusmerkki ja muuta tekstin väri
                 self.offer_label.config(text=f"✓ {self.offer_file}", style="Selected.TLabel")
@@ -360,8 +476,10 @@ class ExcelMatcherApp:
             selected_indices = self.ref_cols_listbox.curselection()
             if len(selected_indices) > 0:
                 self.process_button.config(state=tk.NORMAL)
+                self.dry_run_button.config(state=tk.NORMAL)
                 return
         self.process_button.config(state=tk.DISABLED)
+        self.dry_run_button.config(state=tk.DISABLED)
 
     def validate_selection(self):
         ref_key = self.reference_column_var.get()
@@ -369,19 +487,34 @@ class ExcelMatcherApp:
         if not ref_key or not offer_key:
             messagebox.showerror("Virhe", "Valitse molemmat avainsarakkeet ennen prosessin aloittamista.")
             return False
+
+        # Yhdistelmäavaimessa molemmilla puolilla on oltava yhtä monta lisäavainsaraketta
+        if len(self.ref_extra_keys) != len(self.offer_extra_keys):
+            messagebox.showerror(
+                "Virhe",
+                f"Valitse yhtä monta lisäavainsaraketta molemmista tiedostoista "
+                f"(referenssi: {len(self.ref_extra_keys)}, tarjous: {len(self.offer_extra_keys)})."
+            )
+            return False
         
         if not self.selected_reference_columns:
             messagebox.showerror("Virhe", "Valitse vähintään yksi referenssitiedoston sarake.")
             return False
         
         try:
-            df_reference = pd.read_excel(self.reference_file, dtype=str)
-            df_offer = pd.read_excel(self.offer_file, dtype=str)
+            df_reference = self.read_excel(self.reference_file)
+            df_offer = self.read_excel(self.offer_file)
 
-            # Tarkista referenssitiedoston avainsarake
-            if ref_key not in df_reference.columns:
-                messagebox.showerror("Virhe", f"Sarake '{ref_key}' ei löydy referenssitiedostosta.")
-                return False
+            # Tarkista referenssitiedoston avainsarakkeet
+            for key in [ref_key] + self.ref_extra_keys:
+                if key not in df_reference.columns:
+                    messagebox.showerror("Virhe", f"Sarake '{key}' ei löydy referenssitiedostosta.")
+                    return False
+
+            for key in self.offer_extra_keys:
+                if key not in df_offer.columns:
+                    messagebox.showerror("Virhe", f"Sarake '{key}' ei löydy tarjoustiedostosta.")
+                    return False
 
             # Jos on kyse MATCHED-tiedostosta, etsitään vaihtoehtoisia sarakenimiä
             if "MATCHED_" in self.offer_file:
@@ -421,17 +554,69 @@ class ExcelMatcherApp:
         finally:
             self.progress_bar["value"] = 0
 
-    def process_files(self):
-        # 1) Get the chosen reference key column
-        reference_column = self.reference_column_var.get()
+    def start_dry_run(self):
+        # Kerää käyttäjän valitsemat sarakkeet ennen validointia
+        selected_indices = self.ref_cols_listbox.curselection()
+        self.selected_reference_columns = [self.ref_cols_listbox.get(i) for i in selected_indices]
+
+        if not self.validate_selection():
+            return
+
+        reference_column, competitor_column = self.key_columns()
+        self.processor = self.get_processor()
+        self.processor.selected_ref_columns = self.selected_reference_columns
+        # Etuliite- ja fuzzy-vertailu kohdistuu avaimen ensimmäiseen (pää)sarakkeeseen
+        self.processor.match_component = 0
+        try:
+            report = self.processor.dry_run(
+                self.reference_file,
+                self.offer_file,
+                reference_column,
+                competitor_column
+            )
+        except Exception as e:
+            messagebox.showerror("Virhe", f"Virhe koeajossa:\n{str(e)}")
+            return
+        self.show_dry_run_report(report)
+
+    def show_dry_run_report(self, report):
+        tier_names = {
+            "exact": "Tarkka osuma",
+            "leading_zero": "Etunolla",
+            "prefix": "Etuliite",
+            "fuzzy": "Fuzzy",
+        }
+        stage_names = {
+            "read_reference": "Referenssin luku",
+            "build_index": "Indeksin rakennus",
+            "read_offer": "Tarjouksen luku",
+            "save": "Tallennus",
+        }
+        lines = [f"Otos: {report['sample_rows']} / {report['total_rows']} riviä\n"]
+        for tier, stats in report["tiers"].items():
+            lines.append(f"{tier_names[tier]}: {stats['rate']:.1%} ({stats['matches']} osumaa)")
+        lines.append(f"Ei vastaavaa: {report['unmatched_rate']:.1%}\n")
+        lines.append("Arvioitu kesto:")
+        for stage, seconds in report["estimated_seconds"].items():
+            lines.append(f"  {stage_names.get(stage, tier_names.get(stage, stage))}: {seconds:.1f} s")
+        lines.append(f"Yhteensä: {report['estimated_total_seconds']:.1f} s")
+        if report["warnings"]:
+            lines.append("\nVaroitukset:")
+            lines.extend(f"- {warning}" for warning in report["warnings"])
+            messagebox.showwarning("Koeajo", "\n".join(lines))
+        else:
+            messagebox.showinfo("Koeajo", "\n".join(lines))
 
-        # 2) Get the chosen offer key column
-        competitor_column = self.offer_column_var.get()
+    def process_files(self):
+        # 1) Get the chosen reference and offer key columns (lists for a composite key)
+        reference_column, competitor_column = self.key_columns()
 
-        # Pass these to the logic
+        # 2) Pass these to the logic; prefix and fuzzy tiers use the main key column
+        self.processor = self.get_processor()
         self.processor.ref_key_column = reference_column
         self.processor.offer_key_column = competitor_column
         self.processor.selected_ref_columns = self.selected_reference_columns
+        self.processor.match_component = 0
 
         try:
             total_steps = 3
@@ -461,10 +646,11 @@ class ExcelMatcherApp:
             self.progress_bar["value"] = 100
             self.master.update_idletasks()
 
-            messagebox.showinfo(
-                "Valmis!",
-                f"Uusi tiedosto luotu:\n{final_output_path}\n\nRivejä ilman vastaavuutta: {missing_count}"
-            )
+            message = f"Uusi tiedosto luotu:\n{final_output_path}\n\nRivejä ilman vastaavuutta: {missing_count}"
+            skipped_for_time = self.processor.skipped_for_time
+            if skipped_for_time:
+                message += f"\nNäistä aikarajan vuoksi ohitettuja: {skipped_for_time}"
+            messagebox.showinfo("Valmis!", message)
         except Exception as e:
             raise e
 